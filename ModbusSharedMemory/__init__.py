@@ -1,2 +1,2 @@
 name = "ModbusSharedMemory"
-__all__ = ["client_server", "memory"]
+__all__ = ["client_server", "async_client_server", "memory", "merge", "gateway", "metrics", "persistence", "codec", "planner", "transport"]
@@ -0,0 +1,230 @@
+import asyncio
+from copy import deepcopy
+from time import time
+from umodbus.client import tcp
+from umodbus.utils import unpack_mbap, pack_mbap
+from ModbusSharedMemory.memory import MemoryStore
+from ModbusSharedMemory.merge import merge_memory, MergeResult
+from ModbusSharedMemory.client_server import (ModbusMasterTCP, BaseModbusSlave, _merge_read_run, _take_write_run,
+                                              _restore_write_run, _restore_client_ranges)
+
+
+class AsyncModbusSlaveTCP(BaseModbusSlave):
+
+    def __init__(self, memory_store, server_ip='localhost', slave_id=1, port=502, metrics=None):
+        """
+        Modbus TCP slave served on asyncio streams, one coroutine per connection
+        :param memory_store: MemoryStore instance to be served
+        :param server_ip: address to listen on
+        :param slave_id: slave id to respond to
+        :param port: TCP port to listen on
+        :param metrics: metrics.Metrics collecting request statistics, None disables them
+        :return: AsyncModbusSlaveTCP instance
+        """
+        super().__init__(memory_store, slave_id, metrics)
+        self.server_ip = server_ip
+        self.port = port
+        self.server = None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                mbap_header = await reader.readexactly(7)
+                transaction_id, protocol_id, length, unit_id = unpack_mbap(mbap_header)
+                request_pdu = await reader.readexactly(length - 1)
+
+                response_pdu = self.execute_pdu(unit_id, request_pdu)
+                writer.write(pack_mbap(transaction_id, protocol_id, len(response_pdu) + 1, unit_id) + response_pdu)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        # start listening, connections are served by the running event loop
+        self.server = await asyncio.start_server(self.handle_connection, self.server_ip, self.port, reuse_address=True)
+
+    def kill(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class AsyncModbusMasterTCP:
+
+    sync_modes = {'full', 'dirty'}
+
+    def __init__(self, memory_store, server_ip='localhost', default_slave_id=1, sync_period=0.2, sync_mode='full', port=502):
+        """
+        Modbus TCP master on asyncio streams, same synchronization rules as ModbusMasterTCP,
+        data directions of memory (see MemoryStore.set_direction) included
+        :param memory_store: MemoryStore instance to be exchanged
+        :param server_ip: address of modbus slave
+        :param default_slave_id: slave id used when none is given explicitly
+        :param sync_period: time between synchronization cycles, in seconds
+        :param sync_mode: 'full' (do_map2) or 'dirty' (do_map_dirty), see ModbusMasterTCP
+        :param port: TCP port of modbus slave
+        :return: AsyncModbusMasterTCP instance
+        """
+        if not isinstance(memory_store, MemoryStore):
+            raise ValueError("memory_store should be instance of MemoryStore")
+
+        if sync_mode not in AsyncModbusMasterTCP.sync_modes:
+            raise ValueError("sync_mode should be one of {}".format(AsyncModbusMasterTCP.sync_modes))
+
+        self.memory = memory_store
+        self.buffered_memory = deepcopy(self.memory)
+        self.default_slave_id = default_slave_id
+        self.server_ip = server_ip
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.keep_running = False
+        self.sync_period = sync_period
+        self.sync_mode = sync_mode
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.server_ip, self.port)
+
+    async def send_message(self, request_adu):
+        self.writer.write(request_adu)
+        await self.writer.drain()
+
+        mbap_header = await self.reader.readexactly(7)
+        _, _, length, _ = unpack_mbap(mbap_header)
+        response_adu = mbap_header + await self.reader.readexactly(length - 1)
+
+        tcp.raise_for_exception_adu(response_adu)
+        return tcp.parse_response_adu(response_adu, request_adu)
+
+    async def write_holding_reg(self, address, value, slave_id=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        await self.send_message(tcp.write_single_register(slv_id, address, value))
+
+    async def read_holding_reg(self, address, slave_id=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        response = await self.send_message(tcp.read_holding_registers(slv_id, address, 1))
+
+        return response[0]
+
+    async def write_multiple_reg(self, starting_addr, values, slave_id=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        for starting_idx, ending_idx in ModbusMasterTCP.get_chunk_indices(values, 123):
+            await self.send_message(
+                tcp.write_multiple_registers(slv_id, starting_addr + starting_idx, values[starting_idx:ending_idx]))
+
+    async def write_ranges(self, ranges, slave_id=None):
+        for starting_addr, values in ranges:
+            if len(values) == 1:
+                await self.write_holding_reg(starting_addr, values[0], slave_id)
+            else:
+                await self.write_multiple_reg(starting_addr, values, slave_id)
+
+    async def read_multiple_reg(self, starting_addr, count, slave_id=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+
+        response = [None] * count
+        for starting_idx, ending_idx in ModbusMasterTCP.get_chunk_indices(range(count), 125):
+            response[starting_idx:ending_idx] = await self.send_message(
+                tcp.read_holding_registers(slv_id, starting_addr + starting_idx, ending_idx - starting_idx))
+
+        return response
+
+    async def do_map2(self, slave_id=None, address=0, count=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        count = self.memory.get_size() - address if count is None else count
+        runs = self.memory.get_direction_runs(address, count)
+        if len(runs) > 1 or runs and runs[0][2] != 'both':
+            return await self._map_directed(self.do_map2, runs, slv_id, address, False)
+        server_data = await self.read_multiple_reg(address, count, slv_id)
+        result = merge_memory(self.memory, self.buffered_memory, server_data, address=address)
+
+        try:
+            await self.write_multiple_reg(address, result.outgoing, slv_id)
+        except Exception:
+            _restore_client_ranges(self.memory, self.buffered_memory, result, server_data, address)
+            raise
+        return result
+
+    async def do_map_dirty(self, slave_id=None, address=0, count=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        count = self.memory.get_size() - address if count is None else count
+        runs = self.memory.get_direction_runs(address, count)
+        if len(runs) > 1 or runs and runs[0][2] != 'both':
+            return await self._map_directed(self.do_map_dirty, runs, slv_id, address, True)
+        server_data = await self.read_multiple_reg(address, count, slv_id)
+        result = merge_memory(self.memory, self.buffered_memory, server_data, dirty_only=True, address=address)
+
+        try:
+            await self.write_ranges(
+                [(address + start, result.outgoing[start:start + length]) for start, length in result.client_ranges],
+                slv_id)
+        except Exception:
+            _restore_client_ranges(self.memory, self.buffered_memory, result, server_data, address)
+            raise
+        return result
+
+    async def _map_directed(self, sync, runs, slave_id, address, dirty_only):
+        """
+        Synchronize block with declared data directions run by run, see ModbusMasterTCP._map_directed
+        :return: MergeResult, with outgoing and buffer set to None, ranges relative to address
+        """
+        memory_ranges = []
+        client_ranges = []
+        conflicts = 0
+        for start, length, direction in runs:
+            shift = start - address
+            if direction == 'both':
+                result = await sync(slave_id, start, length)
+                memory_ranges += [(shift + run_start, run_length) for run_start, run_length in result.memory_ranges]
+                client_ranges += [(shift + run_start, run_length) for run_start, run_length in result.client_ranges]
+                conflicts += result.conflicts
+
+            elif direction == 'read':
+                server_data = await self.read_multiple_reg(start, length, slave_id)
+                changed = _merge_read_run(self.memory, self.buffered_memory, start, server_data)
+                memory_ranges += [(shift + run_start, run_length) for run_start, run_length in changed]
+
+            else:
+                dirty_ranges, memory_data, buffer_data = _take_write_run(self.memory, self.buffered_memory, start, length)
+                try:
+                    if dirty_only:
+                        await self.write_ranges([(run_start, memory_data[run_start - start:run_start - start + run_length])
+                                                 for run_start, run_length in dirty_ranges], slave_id)
+                    else:
+                        await self.write_multiple_reg(start, memory_data, slave_id)
+                except Exception:
+                    _restore_write_run(self.memory, self.buffered_memory, start, dirty_ranges, buffer_data)
+                    raise
+                if dirty_only:
+                    client_ranges += [(run_start - address, run_length) for run_start, run_length in dirty_ranges]
+                elif memory_data != buffer_data:
+                    client_ranges.append((shift, length))
+
+        return MergeResult(None, None, memory_ranges, client_ranges, conflicts)
+
+    async def _start(self):
+        self.keep_running = True
+        try:
+            while self.keep_running:
+                t0 = time()
+                if self.sync_mode == 'dirty':
+                    await self.do_map_dirty()
+                else:
+                    await self.do_map2()
+                t1 = time()
+                await asyncio.sleep(max(0, self.sync_period - (t1 - t0)))
+
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            self.writer.close()
+
+    async def run(self):
+        # connect and start synchronization as a task of the running event loop
+        if self.writer is None:
+            await self.connect()
+        return asyncio.ensure_future(self._start())
+
+    def kill(self):
+        self.keep_running = False
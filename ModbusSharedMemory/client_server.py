@@ -1,37 +1,389 @@
-from socketserver import TCPServer
+from socketserver import TCPServer, ThreadingMixIn
 from umodbus import conf
 from umodbus.server.tcp import RequestHandler, get_server
 import socket
 from umodbus.client import tcp
+from umodbus import log
+from umodbus.exceptions import (ModbusError, IllegalFunctionError, IllegalDataAddressError,
+                                IllegalDataValueError, ServerDeviceFailureError, error_code_to_exception_map)
+from umodbus.utils import recv_exactly, pack_exception_pdu, pack_mbap
+import struct
+import sys
+from array import array
 import threading
 from copy import deepcopy
-from time import sleep, time
+from time import sleep, time, perf_counter
 from ModbusSharedMemory.memory import MemoryStore
+from ModbusSharedMemory.merge import merge_memory, three_way_merge, MergeResult
+from ModbusSharedMemory.persistence import load_memory, Checkpointer
+from ModbusSharedMemory.codec import FrameCodec, MBAP_HEADER, MAX_ADU_SIZE, recv_into_exactly
+from ModbusSharedMemory.planner import plan_blocks, CHUNK_SIZES
+import os
 from datetime import datetime
 
 
-class ModbusSlaveTCP:
-    TCPServer.allow_reuse_address = True
+# PDU layouts of supported functions, registers are big endian on the wire
+_READ_REQUEST = struct.Struct('>BHH')
+_READ_RESPONSE_HEADER = struct.Struct('>BB')
+_WRITE_SINGLE_REQUEST = struct.Struct('>BHH')
+_WRITE_MULTIPLE_REQUEST_HEADER = struct.Struct('>BHHB')
+_WRITE_MULTIPLE_RESPONSE = struct.Struct('>BHH')
+_WRITE_COILS_REQUEST_HEADER = struct.Struct('>BHHB')
+_READ_WRITE_REQUEST_HEADER = struct.Struct('>BHHHHB')
+_COIL_ON, _COIL_OFF = 0xFF00, 0x0000
+_SWAP_BYTES = sys.byteorder == 'little'
+
+
+def open_socket(host, port, timeout=None, keepalive=True):
+    """
+    Connect TCP socket to modbus slave, Nagle is disabled, so small requests are not delayed
+    :param host: address of modbus slave
+    :param port: TCP port of modbus slave
+    :param timeout: timeout of connect and of each socket operation, in seconds, None blocks forever
+    :param keepalive: enable TCP keepalive, dead peers are detected in about 20s where supported
+    :return: connected socket
+    """
+    sock = socket.create_connection((host, port), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if keepalive:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', 10), ('TCP_KEEPINTVL', 5), ('TCP_KEEPCNT', 2)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    return sock
+
+
+class TCPTransport:
+
+    def __init__(self, host, port=502, timeout=None, keepalive=True):
+        """
+        Default transport of ModbusMasterTCP, connects TCP sockets with open_socket.
+        Transports are objects with connect method returning a connected socket-like object,
+        having sendall, recv, recv_into, shutdown and close methods, see transport.InProcessTransport.
+        :param host: address of modbus slave
+        :param port: TCP port of modbus slave
+        :param timeout: see open_socket
+        :param keepalive: see open_socket
+        :return: TCPTransport instance
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+
+    def connect(self):
+        return open_socket(self.host, self.port, self.timeout, self.keepalive)
+
+
+class SlaveRequestHandler(RequestHandler):
+
+    def setup(self):
+        # answers to pipelined requests should not wait for ACK of previous ones (Nagle)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def execute_route(self, meta_data, request_pdu):
+        # no per address routing, slave answers for whole requested range
+        return self.server.slave.execute_pdu(meta_data['unit_id'], request_pdu)
+
+
+class FastSlaveRequestHandler(SlaveRequestHandler):
+
+    def handle(self):
+        # lean loop: requests are received into one reused buffer and passed on without copying
+        buffer = bytearray(MAX_ADU_SIZE)
+        view = memoryview(buffer)
+        sock = self.request
+        execute_pdu = self.server.slave.execute_pdu
+        try:
+            while True:
+                recv_into_exactly(sock, view, 7)
+                transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack_from(buffer)
+                if not 2 <= length <= MAX_ADU_SIZE - 6:
+                    return
+                recv_into_exactly(sock, view[7:], length - 1)
+
+                response_pdu = execute_pdu(unit_id, view[7:length + 6])
+                sock.sendall(MBAP_HEADER.pack(transaction_id, protocol_id, len(response_pdu) + 1, unit_id) + response_pdu)
+        except (ValueError, OSError):
+            # closed or broken connection
+            return
+
+
+class SlaveServer(TCPServer):
+    close_timeout = 1.0
+
+    def __init__(self, server_address, request_handler_class):
+        # open connections are tracked, so kill can close them, set before binding which may close server
+        self._requests = set()
+        self._requests_closed = threading.Condition()
+        self._closing = False
+        super().__init__(server_address, request_handler_class)
+
+    def finish_request(self, request, client_address):
+        with self._requests_closed:
+            if self._closing:
+                return
+            self._requests.add(request)
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            with self._requests_closed:
+                self._requests.discard(request)
+                self._requests_closed.notify_all()
 
-    def __init__(self, memory_store, server_ip='localhost', slave_id=1, sync_period=0.05):
+    def close_requests(self):
+        """
+        Refuse new connections and close open ones. Connections are shut down first, so their handlers
+        see closed connection and return, those still open after close_timeout are closed here.
+        """
+        with self._requests_closed:
+            self._closing = True
+            for request in self._requests:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._requests_closed.wait_for(lambda: not self._requests, self.close_timeout)
+            for request in self._requests:
+                request.close()
+            self._requests.clear()
+
+    def server_close(self):
+        super().server_close()
+        self.close_requests()
+
+
+class ThreadingSlaveServer(ThreadingMixIn, SlaveServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, request_handler_class):
+        super().__init__(server_address, request_handler_class)
+        self.max_connections = None
+        self.connections = 0
+        self._connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            if self.max_connections is not None and self.connections >= self.max_connections:
+                # no free slot, refuse connection
+                self.shutdown_request(request)
+                return
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._connections_lock:
+                self.connections -= 1
+
+
+class BaseModbusSlave:
+
+    def __init__(self, memory_store, slave_id=1, metrics=None):
+        """
+        Request processing shared by slave implementations, registers are sliced directly from memory
+        :param memory_store: MemoryStore instance to be served
+        :param slave_id: slave id to respond to
+        :param metrics: metrics.Metrics collecting request statistics, None disables them
+        """
         if not isinstance(memory_store, MemoryStore):
             raise ValueError("memory_store should be instance of MemoryStore")
 
-        self.app = get_server(TCPServer, (server_ip, 502), RequestHandler)
         self.memory = memory_store
-        self.sync_period = sync_period
+        self.slave_id = slave_id
+        self.metrics = metrics
+
+    def read_holding_regs(self, address, count):
+        if not 1 <= count <= 125:
+            raise IllegalDataValueError()
+        if address + count > self.memory.get_size():
+            raise IllegalDataAddressError()
+        return self.memory.get_range(address, count)
+
+    def write_holding_regs(self, address, values):
+        if address + len(values) > self.memory.get_size():
+            raise IllegalDataAddressError()
+        self.memory.set_range(address, values, notify=True)
+
+    def read_input_regs(self, address, count):
+        if not 1 <= count <= 125:
+            raise IllegalDataValueError()
+        if address + count > self.memory.get_area_size('input_registers'):
+            raise IllegalDataAddressError()
+        return self.memory.get_input_range(address, count)
+
+    def read_bits(self, area, address, count):
+        if not 1 <= count <= 2000:
+            raise IllegalDataValueError()
+        if address + count > self.memory.get_area_size(area):
+            raise IllegalDataAddressError()
+        return self.memory.get_packed_bits(area, address, count)
+
+    def write_coils(self, address, count, data):
+        if address + count > self.memory.get_area_size('coils'):
+            raise IllegalDataAddressError()
+        self.memory.set_packed_bits('coils', address, count, data, notify=True)
+
+    def execute_pdu(self, slave_id, request_pdu):
+        """
+        Process request PDU, functions 1, 2, 3, 4, 5, 6, 15, 16 and 23 are supported
+        :param slave_id: unit id from request header
+        :param request_pdu: request PDU bytes
+        :return: response PDU bytes, exception PDU on error
+        """
+        if self.metrics is None:
+            return self._execute_pdu(slave_id, request_pdu)
+
+        t0 = perf_counter()
+        response_pdu = self._execute_pdu(slave_id, request_pdu)
+        metrics = self.metrics
+        metrics.observe('slave_request_seconds', perf_counter() - t0)
+        metrics.inc('slave_requests_total', function_code=request_pdu[0])
+        metrics.inc('slave_bytes_received_total', len(request_pdu))
+        metrics.inc('slave_bytes_sent_total', len(response_pdu))
+        if response_pdu[0] & 0x80:
+            metrics.inc('slave_exceptions_total', function_code=request_pdu[0], error_code=response_pdu[1])
+        return response_pdu
+
+    def _execute_pdu(self, slave_id, request_pdu):
+        function_code = request_pdu[0]
+        try:
+            if slave_id != self.slave_id:
+                raise IllegalDataAddressError()
 
-        read_hr_routing = self.app.route(slave_ids=[slave_id], function_codes=[3], addresses=list(range(self.memory.get_size())))
-        self.read_holding_reg = read_hr_routing(self.read_holding_reg)
-        
-        write_hr_routing = self.app.route(slave_ids=[slave_id], function_codes=[6, 16], addresses=list(range(self.memory.get_size())))
-        self.write_holding_reg = write_hr_routing(self.write_holding_reg)
+            # whole request is atomic for other connections and local users of memory
+            with self.memory.lock:
+                if function_code == 3 or function_code == 4:
+                    _, address, count = _READ_REQUEST.unpack(request_pdu)
+                    if function_code == 3:
+                        values = self.read_holding_regs(address, count)
+                    else:
+                        values = self.read_input_regs(address, count)
+                    if _SWAP_BYTES:
+                        values.byteswap()
+                    return _READ_RESPONSE_HEADER.pack(function_code, 2*count) + values.tobytes()
 
-    def read_holding_reg(self, slave_id, function_code, address):
-        return self.memory.get_value(address)
+                elif function_code == 1 or function_code == 2:
+                    _, address, count = _READ_REQUEST.unpack(request_pdu)
+                    data = self.read_bits('coils' if function_code == 1 else 'discrete_inputs', address, count)
+                    return _READ_RESPONSE_HEADER.pack(function_code, len(data)) + data
 
-    def write_holding_reg(self, slave_id, function_code, address, value):
-        self.memory.set_value(address, value)
+                elif function_code == 5:
+                    _, address, value = _WRITE_SINGLE_REQUEST.unpack(request_pdu)
+                    if value not in (_COIL_ON, _COIL_OFF):
+                        raise IllegalDataValueError()
+                    self.write_coils(address, 1, b'\x01' if value == _COIL_ON else b'\x00')
+                    return request_pdu
+
+                elif function_code == 15:
+                    _, address, count, byte_count = _WRITE_COILS_REQUEST_HEADER.unpack_from(request_pdu)
+                    if not 1 <= count <= 1968 or byte_count != (count + 7) // 8 or len(request_pdu) != 6 + byte_count:
+                        raise IllegalDataValueError()
+                    self.write_coils(address, count, request_pdu[6:])
+                    return _WRITE_MULTIPLE_RESPONSE.pack(function_code, address, count)
+
+                elif function_code == 6:
+                    _, address, value = _WRITE_SINGLE_REQUEST.unpack(request_pdu)
+                    self.write_holding_regs(address, (value, ))
+                    return request_pdu
+
+                elif function_code == 16:
+                    _, address, count, byte_count = _WRITE_MULTIPLE_REQUEST_HEADER.unpack_from(request_pdu)
+                    if not 1 <= count <= 123 or byte_count != 2*count or len(request_pdu) != 6 + byte_count:
+                        raise IllegalDataValueError()
+                    values = array('H')
+                    values.frombytes(request_pdu[6:])
+                    if _SWAP_BYTES:
+                        values.byteswap()
+                    self.write_holding_regs(address, values)
+                    return _WRITE_MULTIPLE_RESPONSE.pack(function_code, address, count)
+
+                elif function_code == 23:
+                    # write is done before read, both under memory lock
+                    _, read_address, read_count, write_address, write_count, byte_count = \
+                        _READ_WRITE_REQUEST_HEADER.unpack_from(request_pdu)
+                    if not 1 <= write_count <= 121 or byte_count != 2*write_count or len(request_pdu) != 10 + byte_count:
+                        raise IllegalDataValueError()
+                    if not 1 <= read_count <= 125:
+                        raise IllegalDataValueError()
+                    if read_address + read_count > self.memory.get_size():
+                        raise IllegalDataAddressError()
+                    values = array('H')
+                    values.frombytes(request_pdu[10:])
+                    if _SWAP_BYTES:
+                        values.byteswap()
+                    self.write_holding_regs(write_address, values)
+                    values = self.read_holding_regs(read_address, read_count)
+                    if _SWAP_BYTES:
+                        values.byteswap()
+                    return _READ_RESPONSE_HEADER.pack(function_code, 2*read_count) + values.tobytes()
+
+                else:
+                    raise IllegalFunctionError(function_code)
+
+        except ModbusError as e:
+            return pack_exception_pdu(function_code, e.error_code)
+        except struct.error:
+            return pack_exception_pdu(function_code, IllegalDataValueError.error_code)
+        except Exception:
+            log.exception('Could not handle request')
+            return pack_exception_pdu(function_code, ServerDeviceFailureError.error_code)
+
+
+class ModbusSlaveTCP(BaseModbusSlave):
+    TCPServer.allow_reuse_address = True
+
+    def __init__(self, memory_store, server_ip='localhost', slave_id=1, sync_period=0.05, concurrent=False, max_connections=None, port=502,
+                 metrics=None, image_path=None, checkpoint_period=None, fast_codec=False):
+        """
+        Modbus TCP slave, serves memory_store to masters
+        :param memory_store: MemoryStore instance to be served
+        :param server_ip: address to listen on
+        :param slave_id: slave id to respond to
+        :param sync_period: poll interval of server loop, in seconds
+        :param concurrent: serve each connection in its own thread, otherwise one master at a time
+        :param max_connections: limit of simultaneous connections in concurrent mode, None for no limit
+        :param port: TCP port to listen on
+        :param metrics: metrics.Metrics collecting request statistics, None disables them
+        :param image_path: memory image file, restored on run when it exists, see persistence.load_memory
+        :param checkpoint_period: time between checkpoints of memory to image_path, in seconds,
+                                  None disables them, see persistence.Checkpointer
+        :param fast_codec: serve connections with lean request loop (FastSlaveRequestHandler)
+                           instead of uModbus request handler
+        :return: ModbusSlaveTCP instance
+        """
+        super().__init__(memory_store, slave_id, metrics)
+
+        if max_connections is not None and not concurrent:
+            raise ValueError("max_connections can be used only in concurrent mode")
+
+        if checkpoint_period is not None and image_path is None:
+            raise ValueError("checkpoint_period requires image_path")
+
+        handler = FastSlaveRequestHandler if fast_codec else SlaveRequestHandler
+        self.app = get_server(ThreadingSlaveServer if concurrent else SlaveServer, (server_ip, port), handler)
+        self.app.slave = self
+        if concurrent:
+            self.app.max_connections = max_connections
+        self.sync_period = sync_period
+        self.image_path = image_path
+        self.checkpointer = None if checkpoint_period is None else Checkpointer(memory_store, image_path, checkpoint_period)
+
+    def restore(self):
+        """
+        Warm start: load memory from image_path, unreadable image is logged and memory is left as is
+        :return: True if memory was restored
+        """
+        if self.image_path is None or not os.path.exists(self.image_path):
+            return False
+        try:
+            load_memory(self.memory, self.image_path)
+        except (OSError, ValueError):
+            log.exception('Could not restore memory image')
+            return False
+        return True
 
     def _start(self):
         try:
@@ -43,89 +395,744 @@ class ModbusSlaveTCP:
             self.app.server_close()
 
     def kill(self):
+        # open connections first, otherwise serving one master at a time would block shutdown
+        self.app.close_requests()
         self.app.shutdown()
         self.app.server_close()
+        if self.checkpointer is not None:
+            self.checkpointer.kill()
 
     def run(self):
+        # memory is restored before first request is served
+        self.restore()
+        if self.checkpointer is not None:
+            self.checkpointer.run()
         th = threading.Thread(group=None, target=self._start, daemon=True)
         th.start()
 
 
+def _merge_read_run(memory, buffered_memory, start, server_data):
+    # 'read' run takes slave values, local writes are dropped, returns changed ranges relative to start
+    server_data = array('H', server_data)
+    changed = []
+    with memory.lock:
+        memory.pop_dirty_ranges(start, len(server_data))
+        memory_data = memory.get_range(start, len(server_data))
+        if memory_data != server_data:
+            # memory as buffer: every difference is taken from slave
+            changed = three_way_merge(server_data, memory_data, memory_data).memory_ranges
+            for run_start, run_length in changed:
+                memory.set_range(start + run_start, server_data[run_start:run_start + run_length],
+                                 mark_dirty=False, notify=True)
+        buffered_memory.set_range(start, server_data)
+    return changed
+
+
+def _take_write_run(memory, buffered_memory, start, length):
+    # 'write' run is sent as it is, returns popped dirty ranges, memory and previous buffer words
+    with memory.lock:
+        dirty_ranges = memory.pop_dirty_ranges(start, length)
+        memory_data = memory.get_range(start, length)
+        buffer_data = buffered_memory.get_range(start, length)
+        buffered_memory.set_range(start, memory_data)
+    return dirty_ranges, memory_data, buffer_data
+
+
+def _restore_write_run(memory, buffered_memory, start, dirty_ranges, buffer_data):
+    # write of 'write' run failed: its registers are dirty again and sent next cycle
+    with memory.lock:
+        buffered_memory.set_range(start, buffer_data)
+        for run_start, run_length in dirty_ranges:
+            memory.mark_dirty(run_start, run_length)
+
+
+def _restore_client_ranges(memory, buffered_memory, result, server_data, address):
+    # write back failed: local values are kept and sent again next cycle, buffer gets back the
+    # values merge replaced, which for client ranges equal server values
+    with memory.lock:
+        for start, length in result.client_ranges:
+            buffered_memory.set_range(address + start, server_data[start:start + length])
+            memory.mark_dirty(address + start, length)
+
+
+class _SyncRegion:
+
+    def __init__(self, address, count, period, max_period, area='holding_registers'):
+        # block of memory area polled at its own rate, interval grows up to max_period while block is idle
+        self.area = area
+        self.address = address
+        self.count = count
+        self.period = period
+        self.max_period = max_period
+        self.interval = period
+        self.due = 0.0
+        self.last = 0.0 # start of last synchronization
+
+    def overlaps(self, ranges):
+        return any(address < self.address + self.count and self.address < address + count
+                   for address, count in ranges)
+
+
 class ModbusMasterTCP:
 
-    def __init__(self, memory_store, server_ip='localhost', default_slave_id=1, sync_period=0.2):
+    sync_modes = {'full', 'dirty', 'fc23'}
+
+    def __init__(self, memory_store, server_ip='localhost', default_slave_id=1, sync_period=0.2, sync_mode='full', pipeline_depth=1,
+                 max_period=None, wake_on_write=False, port=502, address_offset=0, connection=None, metrics=None,
+                 timeout=5.0, keepalive=True, reconnect=True, reconnect_delay=0.5, max_reconnect_delay=30.0,
+                 fast_codec=False, area_offsets=None, transport=None, wake_period=0.0):
+        """
+        Modbus TCP master, keeps memory_store in sync with a slave
+        :param memory_store: MemoryStore instance to be exchanged
+        :param server_ip: address of modbus slave
+        :param default_slave_id: slave id used when none is given explicitly
+        :param sync_period: time between synchronization cycles, in seconds
+        :param sync_mode: 'full' writes whole memory back each cycle (do_map2),
+                          'dirty' writes back only locally changed registers (do_map_dirty),
+                          'fc23' writes changed registers and reads fresh ones in single exchanges (do_map_fc23)
+        :param pipeline_depth: max number of requests in flight on the socket, matched by transaction id,
+                               1 waits for every response before sending next request
+        :param max_period: back off limit, in seconds: period of a region doubles after each cycle without
+                           changes on either side, up to max_period, None keeps periods fixed
+        :param wake_on_write: synchronize regions as soon as they are written locally, requires sync_mode 'dirty' or 'fc23'
+        :param port: TCP port of modbus slave
+        :param address_offset: slave address of first memory register, eg. 40000 to mirror slave registers
+                               40000.. without allocating 40000 unused ones
+        :param connection: shared connection from gateway.ConnectionPool, used instead of own socket,
+                           server_ip and port are then ignored
+        :param metrics: metrics.Metrics collecting request and sync statistics, None disables them
+        :param timeout: timeout of connect and of each socket operation, in seconds, None blocks forever
+        :param keepalive: enable TCP keepalive on own socket
+        :param reconnect: on lost connection, sync loop marks memory stale and reconnects,
+                          otherwise it stops. Constructor then does not connect, first request does,
+                          without reconnect it connects at once and raises when slave is down
+        :param reconnect_delay: first delay before reconnecting, in seconds, doubled after each failure
+        :param max_reconnect_delay: limit of reconnect delay, in seconds
+        :param fast_codec: frame functions 3, 4, 6 and 16 with codec.FrameCodec (reused buffers, registers
+                           read straight into arrays) instead of uModbus, requires pipeline_depth=1
+        :param area_offsets: slave addresses of first input register, coil and discrete input, dict by area,
+                             same as address_offset for holding registers, missing areas start at 0
+        :param transport: connects own socket, None for TCPTransport to server_ip and port,
+                          eg. transport.InProcessTransport for a slave in the same process
+        :param wake_period: min time between start of a region's synchronization and its next one woken
+                            by a write, in seconds, writes made earlier wait for it, 0 wakes at once
+        :return: ModbusMasterTCP instance
+        """
         if not isinstance(memory_store, MemoryStore):
             raise ValueError("memory_store should be instance of MemoryStore")
 
+        if sync_mode not in ModbusMasterTCP.sync_modes:
+            raise ValueError("sync_mode should be one of {}".format(ModbusMasterTCP.sync_modes))
+
+        if pipeline_depth < 1:
+            raise ValueError("pipeline_depth should be at least 1")
+
+        if max_period is not None and max_period < sync_period:
+            raise ValueError("max_period should not be shorter than sync_period")
+
+        if fast_codec and pipeline_depth != 1:
+            raise ValueError("fast_codec requires pipeline_depth=1")
+
+        if wake_on_write and sync_mode == 'full':
+            raise ValueError("wake_on_write requires sync_mode 'dirty' or 'fc23'")
+        if wake_period < 0:
+            raise ValueError("wake_period should not be negative")
+
+        offsets = dict(area_offsets or {}, holding_registers=address_offset)
+        if set(offsets) - set(CHUNK_SIZES):
+            raise ValueError("area_offsets should be given for areas {}".format(set(CHUNK_SIZES)))
+        if not all(-0xFFFF <= offset <= 0xFFFF for offset in offsets.values()):
+            raise ValueError("address_offset should be in range of (-65535, 65535)")
+
         self.memory = memory_store
         self.buffered_memory = deepcopy(self.memory)
         self.default_slave_id = default_slave_id
-        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
         self.server_ip = server_ip
-        self.socket.connect((self.server_ip, 502))
+        self.port = port
+        self.address_offset = address_offset
+        self.area_offsets = offsets
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.connection = connection
+        self.transport = TCPTransport(server_ip, port, timeout, keepalive) if transport is None else transport
+        # with reconnect, first request (or sync cycle) connects, so a slave down at start is retried
+        self.socket = None
+        if connection is None:
+            self.socket_lock = threading.RLock()
+            if not reconnect:
+                self.connect()
+        else:
+            # exchanges of masters sharing the socket are serialized by its lock
+            self.socket_lock = connection.lock
+            if not reconnect:
+                self.socket = connection.get_socket()
+        self._killed = threading.Event()
+        self.metrics = metrics
+        self._requests_sent = 0
+        self.codec = FrameCodec() if fast_codec else None
+        self.fc23_supported = None # unknown until first function 23 exchange
         self.keep_running = False
         self.sync_period = sync_period
+        self.sync_mode = sync_mode
+        self.pipeline_depth = pipeline_depth
+        self.max_period = max_period
+        self.wake_on_write = wake_on_write
+        self.wake_period = wake_period
+        self.regions = []
+        self.stats = {}
+        self.reset_stats()
+        self._transaction_id = 0
+
+    def add_region(self, address, count, period=None, max_period=None, area='holding_registers'):
+        """
+        Poll block of memory at its own rate, eg. alarm words fast and recipes slow.
+        Once regions are added, only registers covered by them are synchronized.
+        :param address: starting address of region, in words (bits for coils and discrete inputs)
+        :param count: number of words in region
+        :param period: time between synchronizations of region, in seconds, None for sync_period
+        :param max_period: back off limit of region, None for max_period of master,
+                           equal to period keeps region polled at fixed rate
+        :param area: memory area of region, see MemoryStore
+        """
+        if not (0 <= address and count > 0 and address + count <= self.memory.get_area_size(area)):
+            raise ValueError("Size exceeded")
+        offset = self.area_offsets.get(area, 0)
+        if not (0 <= offset + address and offset + address + count <= 0x10000):
+            raise ValueError("region should be mapped in range of (0, 65535) slave addresses")
+
+        period = self.sync_period if period is None else period
+        max_period = self.max_period if max_period is None else max_period
+        if period <= 0:
+            raise ValueError("period should be positive")
+        if max_period is not None and max_period < period:
+            raise ValueError("max_period should not be shorter than period")
+        if any(region.area == area and region.overlaps([(address, count)]) for region in self.regions):
+            raise ValueError("region overlaps already added region")
+
+        self.regions.append(_SyncRegion(address, count, period, max_period, area))
+
+    def add_planned_regions(self, request_cost=1.0, unit_cost=0.02, period=None, max_period=None, areas=None):
+        """
+        Add regions covering only address space used by declared variables of memory, neighbouring
+        variables are merged when bridging their gap is cheaper than another request, see planner.plan_blocks.
+        Variables should be declared before. Registers outside of regions are not synchronized.
+        :param request_cost: cost of one round trip
+        :param unit_cost: cost of one register (or bit) of payload, relative to request_cost
+        :param period: time between synchronizations of regions, see add_region
+        :param max_period: back off limit of regions, see add_region
+        :param areas: memory areas to plan, None for all areas with variables
+        :return: list of (area, address, count) tuples of added regions
+        """
+        planned = []
+        for area in (CHUNK_SIZES if areas is None else areas):
+            ranges = self.memory.get_used_ranges(area)
+            for address, count in plan_blocks(ranges, CHUNK_SIZES[area], request_cost, unit_cost):
+                self.add_region(address, count, period, max_period, area)
+                planned.append((area, address, count))
+        return planned
+
+    def reset_stats(self):
+        # cycles: region synchronizations, wakeups: of those, triggered by local writes
+        # jitter: delay of scheduled synchronization behind its due time, in seconds
+        # overruns: synchronizations which took longer than period of region
+        # connection_errors: lost connections and failed reconnects
+        self.stats.update(cycles=0, wakeups=0, overruns=0, idle_cycles=0, connection_errors=0,
+                          max_jitter=0.0, total_jitter=0.0, max_duration=0.0, last_duration=0.0)
+
+    def get_stats(self):
+        """
+        Scheduler statistics, see reset_stats
+        :return: dict of counters, with mean_jitter
+        """
+        stats = dict(self.stats)
+        scheduled = stats['cycles'] - stats['wakeups']
+        stats['mean_jitter'] = stats['total_jitter'] / scheduled if scheduled else 0.0
+        return stats
+
+    def connect(self):
+        """
+        Open own socket to slave, done by first request (or by constructor, without reconnect) and,
+        after a lost connection, by next request
+        """
+        with self.socket_lock:
+            self._disconnect()
+            self.socket = self.transport.connect()
+
+    def _disconnect(self):
+        if self.connection is not None:
+            # first master noticing broken shared socket closes it, others reconnect with it
+            self.connection.drop(self.socket)
+        elif self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        self.socket = None
 
     def write_holding_reg(self, address, value, slave_id=None):
         slv_id = self.default_slave_id if slave_id is None else slave_id
-        request_adu = tcp.write_single_register(slv_id, address, value)
-        tcp.send_message(request_adu, self.socket)
+        if self.codec is not None:
+            self.write_ranges([(address, [value])], slv_id)
+            return
+        self.send_messages([tcp.write_single_register(slv_id, address, value)])
 
     def read_holding_reg(self, address, slave_id=None):
         slv_id = self.default_slave_id if slave_id is None else slave_id
-        request_adu = tcp.read_holding_registers(slv_id, address, 1)
-        response = tcp.send_message(request_adu, self.socket)
-        
+        if self.codec is not None:
+            return self.read_multiple_reg(address, 1, slv_id)[0]
+        response = self.send_messages([tcp.read_holding_registers(slv_id, address, 1)])[0]
+
         return response[0]
 
     def write_multiple_reg(self, starting_addr, values, slave_id=None):
         slv_id = self.default_slave_id if slave_id is None else slave_id
-        for starting_idx, ending_idx in self.get_chunk_indices(values, 123): 
-            request_adu = tcp.write_multiple_registers(slv_id, starting_addr + starting_idx, values[starting_idx:ending_idx])
-            tcp.send_message(request_adu, self.socket)
-            
-    def read_multiple_reg(self, starting_addr, count, slave_id=None):
+        if self.codec is not None:
+            self._locked(self._fast_write, slv_id, [(starting_addr, self._words(values))], False)
+            return
+        self.send_messages(self._write_adus(starting_addr, values, slv_id))
+
+    def write_ranges(self, ranges, slave_id=None):
+        """
+        Write several blocks of registers, FC16 for each block, FC6 for single registers
+        :param ranges: iterable of (starting_addr, values) tuples
+        """
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        if self.codec is not None:
+            ranges = [(starting_addr, self._words(values)) for starting_addr, values in ranges]
+            self._locked(self._fast_write, slv_id, ranges, True)
+            return
+        request_adus = []
+        for starting_addr, values in ranges:
+            if len(values) == 1:
+                request_adus.append(tcp.write_single_register(slv_id, starting_addr, values[0]))
+            else:
+                request_adus.extend(self._write_adus(starting_addr, values, slv_id))
+        self.send_messages(request_adus)
+
+    def read_input_regs(self, starting_addr, count, slave_id=None):
+        if self.codec is not None:
+            return self._locked(self._fast_read, 4, starting_addr, count, slave_id)
+        return self._read_chunks(tcp.read_input_registers, starting_addr, count, 125, slave_id)
+
+    def read_coils(self, starting_addr, count, slave_id=None):
+        return self._read_chunks(tcp.read_coils, starting_addr, count, 2000, slave_id)
+
+    def read_discrete_inputs(self, starting_addr, count, slave_id=None):
+        return self._read_chunks(tcp.read_discrete_inputs, starting_addr, count, 2000, slave_id)
+
+    def write_coils(self, ranges, slave_id=None):
+        """
+        Write several blocks of coils, FC15 for each block, FC5 for single coils
+        :param ranges: iterable of (starting_addr, values) tuples
+        """
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        request_adus = []
+        for starting_addr, values in ranges:
+            if len(values) == 1:
+                request_adus.append(tcp.write_single_coil(slv_id, starting_addr, int(values[0])))
+            else:
+                request_adus.extend(
+                    tcp.write_multiple_coils(slv_id, starting_addr + starting_idx, [int(bit) for bit in values[starting_idx:ending_idx]])
+                    for starting_idx, ending_idx in self.get_chunk_indices(values, 1968))
+        self.send_messages(request_adus)
+
+    def _read_chunks(self, build_request, starting_addr, count, chunk_size, slave_id):
         slv_id = self.default_slave_id if slave_id is None else slave_id
-        
+        chunks = list(self.get_chunk_indices(range(count), chunk_size))
+        request_adus = [build_request(slv_id, starting_addr + starting_idx, ending_idx - starting_idx)
+                        for starting_idx, ending_idx in chunks]
+
         response = [None] * count
-        for starting_idx, ending_idx in self.get_chunk_indices(range(count), 125):
-            request_adu = tcp.read_holding_registers(slv_id, starting_addr + starting_idx, ending_idx - starting_idx)
-            response[starting_idx:ending_idx] = tcp.send_message(request_adu, self.socket)
+        for (starting_idx, ending_idx), data in zip(chunks, self.send_messages(request_adus)):
+            response[starting_idx:ending_idx] = data
 
         return response
 
-    def do_map2(self, slave_id=None):
+    def _write_adus(self, starting_addr, values, slave_id):
+        return [tcp.write_multiple_registers(slave_id, starting_addr + starting_idx, values[starting_idx:ending_idx])
+                for starting_idx, ending_idx in self.get_chunk_indices(values, 123)]
+
+    def read_multiple_reg(self, starting_addr, count, slave_id=None):
+        if self.codec is not None:
+            return self._locked(self._fast_read, 3, starting_addr, count, slave_id)
+        return self._read_chunks(tcp.read_holding_registers, starting_addr, count, 125, slave_id)
+
+    @staticmethod
+    def _words(values):
+        # validated before socket is used, codec packs without further checks
+        if isinstance(values, array) and values.typecode == 'H':
+            return values
+        try:
+            return array('H', values)
+        except OverflowError:
+            raise ValueError("values should be in range of (0, 65535)")
+
+    def _fast_read(self, function_code, starting_addr, count, slave_id):
+        # chunks are received straight into result, swapped to native order at once
         slv_id = self.default_slave_id if slave_id is None else slave_id
-        server_data = self.read_multiple_reg(0, self.memory.get_size())
-        memory_data = [self.memory.get_value(i) for i in range(self.memory.get_size())]
-        buffer_data = [self.buffered_memory.get_value(i) for i in range(self.buffered_memory.get_size())]
+        words = array('H', bytes(2*count))
+        buffer = memoryview(words).cast('B')
+        for starting_idx, ending_idx in self.get_chunk_indices(range(count), 125):
+            t0 = perf_counter()
+            sizes = self.codec.read_registers(self.socket, slv_id, function_code, starting_addr + starting_idx,
+                                              ending_idx - starting_idx, buffer, 2*starting_idx)
+            self._count_request(t0, sizes)
+        buffer.release()
+        if _SWAP_BYTES:
+            words.byteswap()
+        return words
 
-        outgoing_data = server_data.copy()
+    def _fast_write(self, slave_id, ranges, single):
+        # single: FC6 for single registers, as write_ranges does
+        for starting_addr, values in ranges:
+            if single and len(values) == 1:
+                t0 = perf_counter()
+                self._count_request(t0, self.codec.write_register(self.socket, slave_id, starting_addr, values[0]))
+                continue
+            for starting_idx, ending_idx in self.get_chunk_indices(values, 123):
+                t0 = perf_counter()
+                sizes = self.codec.write_registers(self.socket, slave_id, starting_addr + starting_idx,
+                                                   values[starting_idx:ending_idx])
+                self._count_request(t0, sizes)
 
-        for i in range(self.memory.get_size()):
-            mem_value = memory_data[i]
-            server_value = server_data[i]
-            buf_value = buffer_data[i]
+    def _count_request(self, t0, sizes):
+        self._requests_sent += 1
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.observe('master_request_seconds', perf_counter() - t0)
+            metrics.inc('master_requests_total')
+            metrics.inc('master_bytes_sent_total', sizes[0])
+            metrics.inc('master_bytes_received_total', sizes[1])
 
-            # make decision
-            if server_value != mem_value and mem_value != buf_value and server_value != buf_value:
-                # conflict, server and client updated same value
-                # shift memory, update memory
-                self.buffered_memory.set_value(i, mem_value)
-                self.memory.set_value(i, server_value)
-            elif server_value != mem_value and mem_value == buf_value:
-                # no conflict, server updated, client did not
-                # read from server
-                self.buffered_memory.set_value(i, server_value)
-                self.memory.set_value(i, server_value)
-            elif server_value == buf_value and mem_value != buf_value:
-                # no conflict, client updated, server did not
-                # write to the server
-                self.buffered_memory.set_value(i, mem_value)
-                outgoing_data[i] = mem_value
+    def send_messages(self, request_adus):
+        """
+        Send requests and collect parsed responses, pipelined when pipeline_depth > 1
+        :param request_adus: list of request ADUs
+        :return: list of parsed responses, in order of requests
+        """
+        return self._locked(self._exchange, request_adus)
+
+    def _locked(self, exchange, *args):
+        # exchange on connected socket, under socket lock, lost connection is raised as ConnectionError
+        with self.socket_lock:
+            try:
+                if self.connection is not None:
+                    self.socket = self.connection.get_socket()
+                elif self.socket is None:
+                    self.connect()
+                return exchange(*args)
+            except (OSError, ValueError) as e:
+                # timeout, reset or partial read, position in stream is lost so socket can not be reused
+                self._disconnect()
+                raise ConnectionError("connection to {}:{} lost: {!r}".format(self.server_ip, self.port, e)) from e
+
+    def _exchange(self, request_adus):
+        self._requests_sent += len(request_adus)
+        metrics = self.metrics
+        # function 23 is not known to umodbus, such requests go through the generic loop below
+        if self.pipeline_depth == 1 and all(request_adu[7] != 23 for request_adu in request_adus):
+            if metrics is None:
+                return [tcp.send_message(request_adu, self.socket) for request_adu in request_adus]
+
+            responses = []
+            for request_adu in request_adus:
+                t0 = perf_counter()
+                responses.append(tcp.send_message(request_adu, self.socket))
+                metrics.observe('master_request_seconds', perf_counter() - t0)
+                metrics.inc('master_requests_total')
+                metrics.inc('master_bytes_sent_total', len(request_adu))
+                metrics.inc('master_bytes_received_total', 7 + tcp.expected_response_pdu_size_from_request_pdu(request_adu[7:]))
+            return responses
+
+        responses = [None] * len(request_adus)
+        in_flight = {}
+        error = None
+        next_idx = 0
+        while in_flight or (next_idx < len(request_adus) and error is None):
+            # fill the pipe, each request gets its own transaction id
+            burst = []
+            sent_at = perf_counter()
+            while next_idx < len(request_adus) and len(in_flight) < self.pipeline_depth and error is None:
+                self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+                request_adu = bytearray(request_adus[next_idx])
+                struct.pack_into('>H', request_adu, 0, self._transaction_id)
+                in_flight[self._transaction_id] = (next_idx, request_adu, sent_at)
+                burst.append(request_adu)
+                next_idx += 1
+            if burst:
+                self.socket.sendall(b''.join(burst))
+
+            # responses may come in any order
+            mbap_header = recv_exactly(self.socket.recv, 7)
+            transaction_id, _, length, _ = struct.unpack('>HHHB', mbap_header)
+            response_adu = mbap_header + recv_exactly(self.socket.recv, length - 1)
+            if transaction_id not in in_flight:
+                # late answer to some previous request
+                continue
+
+            idx, request_adu, request_sent_at = in_flight.pop(transaction_id)
+            if metrics is not None:
+                metrics.observe('master_request_seconds', perf_counter() - request_sent_at)
+                metrics.inc('master_requests_total')
+                metrics.inc('master_bytes_sent_total', len(request_adu))
+                metrics.inc('master_bytes_received_total', len(response_adu))
+            try:
+                if request_adu[7] == 23:
+                    # umodbus takes any response of function 23 for an exception
+                    if response_adu[7] & 0x80:
+                        raise error_code_to_exception_map[response_adu[8]]
+                    responses[idx] = list(struct.unpack_from('>{}H'.format(response_adu[8] // 2), response_adu, 9))
+                else:
+                    tcp.raise_for_exception_adu(response_adu)
+                    responses[idx] = tcp.parse_response_adu(response_adu, request_adu)
+            except ModbusError as e:
+                # stop sending, but drain requests already in flight
+                error = error or e
+
+        if error is not None:
+            raise error
+
+        return responses
+
+    def do_map2(self, slave_id=None, address=0, count=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        count = self.memory.get_size() - address if count is None else count
+        runs = self.memory.get_direction_runs(address, count)
+        if len(runs) > 1 or runs and runs[0][2] != 'both':
+            return self._map_directed(self.do_map2, runs, slv_id, address, False)
+        requests_sent = self._requests_sent
+        server_data = self.read_multiple_reg(self.address_offset + address, count, slv_id)
+        result = merge_memory(self.memory, self.buffered_memory, server_data, address=address)
 
         # send
-        self.write_multiple_reg(0, outgoing_data, slv_id)       
+        try:
+            self.write_multiple_reg(self.address_offset + address, result.outgoing, slv_id)
+        except Exception:
+            _restore_client_ranges(self.memory, self.buffered_memory, result, server_data, address)
+            raise
+        if self.metrics is not None:
+            self._record_cycle(result, self._requests_sent - requests_sent)
+        return result
+
+    def do_map_dirty(self, slave_id=None, address=0, count=None):
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        count = self.memory.get_size() - address if count is None else count
+        runs = self.memory.get_direction_runs(address, count)
+        if len(runs) > 1 or runs and runs[0][2] != 'both':
+            return self._map_directed(self.do_map_dirty, runs, slv_id, address, True)
+        requests_sent = self._requests_sent
+        server_data = self.read_multiple_reg(self.address_offset + address, count, slv_id)
+        result = merge_memory(self.memory, self.buffered_memory, server_data, dirty_only=True, address=address)
+
+        # send only changed registers, coalesced
+        wire_address = self.address_offset + address
+        try:
+            self.write_ranges(
+                [(wire_address + start, result.outgoing[start:start + length]) for start, length in result.client_ranges],
+                slv_id)
+        except Exception:
+            _restore_client_ranges(self.memory, self.buffered_memory, result, server_data, address)
+            raise
+        if self.metrics is not None:
+            self._record_cycle(result, self._requests_sent - requests_sent)
+        return result
+
+    def do_map_fc23(self, slave_id=None, address=0, count=None):
+        """
+        Dirty synchronization with function 23 (read/write multiple registers): each chunk read
+        carries one block of locally changed registers, so a cycle needs about half the exchanges.
+        Slave writes before it reads, so local writes win over changes made by slave meanwhile.
+        Falls back to do_map_dirty, for this and next cycles, when slave does not support function 23.
+        :return: MergeResult
+        """
+        if self.fc23_supported is False:
+            return self.do_map_dirty(slave_id, address, count)
+
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        count = self.memory.get_size() - address if count is None else count
+        runs = self.memory.get_direction_runs(address, count)
+        if len(runs) > 1 or runs and runs[0][2] != 'both':
+            return self._map_directed(self.do_map_fc23, runs, slv_id, address, True)
+        requests_sent = self._requests_sent
+        wire_address = self.address_offset + address
+
+        with self.memory.lock:
+            dirty_ranges = self.memory.pop_dirty_ranges(address, count)
+            memory_data = self.memory.get_range(address, count)
+
+        # blocks to be written, relative to address, at most 121 registers each
+        blocks = []
+        for start, length in dirty_ranges:
+            start -= address
+            for starting_idx, ending_idx in self.get_chunk_indices(range(length), 121):
+                blocks.append((start + starting_idx, memory_data[start + starting_idx:start + ending_idx]))
+
+        reads = list(self.get_chunk_indices(range(count), 125))
+        request_adus = []
+        for idx, (starting_idx, ending_idx) in enumerate(reads):
+            if idx < len(blocks):
+                write_start, values = blocks[idx]
+                request_adus.append(self._read_write_adu(
+                    slv_id, wire_address + starting_idx, ending_idx - starting_idx, wire_address + write_start, values))
+            else:
+                request_adus.append(tcp.read_holding_registers(slv_id, wire_address + starting_idx, ending_idx - starting_idx))
+        # more blocks than reads
+        for write_start, values in blocks[len(reads):]:
+            request_adus.extend(self._write_adus(wire_address + write_start, values, slv_id))
+
+        try:
+            responses = self.send_messages(request_adus)
+        except IllegalFunctionError:
+            self.fc23_supported = False
+            for start, length in dirty_ranges:
+                self.memory.mark_dirty(start, length)
+            return self.do_map_dirty(slave_id, address, count)
+        except Exception:
+            # popped registers are sent again next cycle
+            for start, length in dirty_ranges:
+                self.memory.mark_dirty(start, length)
+            raise
+        if blocks:
+            self.fc23_supported = True
+
+        server_data = array('H', bytes(2*count))
+        for (starting_idx, ending_idx), values in zip(reads, responses):
+            server_data[starting_idx:ending_idx] = array('H', values)
+        # blocks written after their registers were read
+        for write_start, values in blocks:
+            server_data[write_start:write_start + len(values)] = values
+
+        with self.memory.lock:
+            memory_data = self.memory.get_range(address, count)
+            new_data = array('H', server_data)
+            # registers written locally during exchange are kept, they are sent next cycle
+            for start, length in self.memory.get_dirty_ranges():
+                start, stop = max(start, address) - address, min(start + length, address + count) - address
+                if start < stop:
+                    new_data[start:stop] = memory_data[start:stop]
+            merged = three_way_merge(new_data, memory_data, memory_data)
+            for start, length in merged.memory_ranges:
+                self.memory.set_range(address + start, new_data[start:start + length], mark_dirty=False, notify=True)
+            self.buffered_memory.set_range(address, server_data)
+
+        result = MergeResult(new_data, server_data, merged.memory_ranges,
+                             [(start, len(values)) for start, values in blocks], 0)
+        if self.metrics is not None:
+            self._record_cycle(result, self._requests_sent - requests_sent)
+        return result
+
+    @staticmethod
+    def _read_write_adu(slave_id, read_address, read_count, write_address, values):
+        values = array('H', values)
+        if _SWAP_BYTES:
+            values.byteswap()
+        pdu = _READ_WRITE_REQUEST_HEADER.pack(23, read_address, read_count, write_address, len(values), 2*len(values)) \
+            + values.tobytes()
+        # transaction id is set when sent
+        return pack_mbap(0, 0, len(pdu) + 1, slave_id) + pdu
+
+    def _map_directed(self, sync, runs, slave_id, address, dirty_only):
+        """
+        Synchronize block with declared data directions (see MemoryStore.set_direction), run by run:
+        'both' runs by sync, 'read' runs are only read and take slave values, local writes to them are
+        dropped, 'write' runs are never read, only written: whole run in full mode, changed registers
+        when dirty_only.
+        :return: MergeResult, with outgoing and buffer set to None, ranges relative to address
+        """
+        memory_ranges = []
+        client_ranges = []
+        conflicts = 0
+        for start, length, direction in runs:
+            wire_address = self.address_offset + start
+            shift = start - address
+            if direction == 'both':
+                result = sync(slave_id, start, length)
+                memory_ranges += [(shift + run_start, run_length) for run_start, run_length in result.memory_ranges]
+                client_ranges += [(shift + run_start, run_length) for run_start, run_length in result.client_ranges]
+                conflicts += result.conflicts
+
+            elif direction == 'read':
+                server_data = self.read_multiple_reg(wire_address, length, slave_id)
+                changed = _merge_read_run(self.memory, self.buffered_memory, start, server_data)
+                memory_ranges += [(shift + run_start, run_length) for run_start, run_length in changed]
+
+            else:
+                dirty_ranges, memory_data, buffer_data = _take_write_run(self.memory, self.buffered_memory, start, length)
+                try:
+                    if dirty_only:
+                        self.write_ranges([(self.address_offset + run_start, memory_data[run_start - start:run_start - start + run_length])
+                                           for run_start, run_length in dirty_ranges], slave_id)
+                    else:
+                        self.write_multiple_reg(wire_address, memory_data, slave_id)
+                except Exception:
+                    _restore_write_run(self.memory, self.buffered_memory, start, dirty_ranges, buffer_data)
+                    raise
+                if dirty_only:
+                    client_ranges += [(run_start - address, run_length) for run_start, run_length in dirty_ranges]
+                elif memory_data != buffer_data:
+                    client_ranges.append((shift, length))
+
+        return MergeResult(None, None, memory_ranges, client_ranges, conflicts)
+
+    def do_map_area(self, area, slave_id=None, address=0, count=None):
+        """
+        Synchronize input registers, discrete inputs or coils, with bulk reads. Input areas are
+        only read. Coils written locally since last cycle are written to slave, they win over
+        changes made by slave meanwhile, other coils take slave values.
+        :param area: 'input_registers', 'discrete_inputs' or 'coils'
+        :return: MergeResult, with outgoing and buffer set to None
+        """
+        slv_id = self.default_slave_id if slave_id is None else slave_id
+        count = self.memory.get_area_size(area) - address if count is None else count
+        requests_sent = self._requests_sent
+        client_ranges = []
+        wire_address = self.area_offsets.get(area, 0) + address
+
+        if area == 'input_registers':
+            server_data = array('H', self.read_input_regs(wire_address, count, slv_id))
+            with self.memory.lock:
+                changed = self.memory.get_input_range(address, count) != server_data
+                if changed:
+                    self.memory.set_input_range(address, server_data, notify=True)
+
+        elif area == 'discrete_inputs' or area == 'coils':
+            server_data = [bool(bit) for bit in (self.read_coils if area == 'coils' else self.read_discrete_inputs)(wire_address, count, slv_id)]
+            with self.memory.lock:
+                old_data = self.memory.get_bits(area, address, count)
+                if area == 'coils':
+                    # local writes win, slave values are taken elsewhere
+                    for start, length in self.memory.pop_dirty_ranges(address, count, 'coils'):
+                        start -= address
+                        server_data[start:start + length] = old_data[start:start + length]
+                        client_ranges.append((start, length))
+                changed = old_data != server_data
+                if changed:
+                    self.memory.set_bits(area, address, server_data, mark_dirty=False, notify=True)
+            if client_ranges:
+                try:
+                    self.write_coils([(wire_address + start, server_data[start:start + length]) for start, length in client_ranges], slv_id)
+                except Exception:
+                    # popped coils are sent again next cycle
+                    for start, length in client_ranges:
+                        self.memory.mark_dirty(address + start, length, 'coils')
+                    raise
+
+        else:
+            raise ValueError("area should be one of 'input_registers', 'discrete_inputs', 'coils'")
+
+        result = MergeResult(None, None, [(0, count)] if changed else [], client_ranges, 0)
+        if self.metrics is not None:
+            self._record_cycle(result, self._requests_sent - requests_sent)
+        return result
+
+    def _record_cycle(self, result, requests):
+        self.metrics.observe('master_chunks_per_cycle', requests)
+        if result.conflicts:
+            self.metrics.inc('master_conflicts_total', result.conflicts)
 
     def do_map(self, slave_id=None):
         slv_id = self.default_slave_id if slave_id is None else slave_id
@@ -142,12 +1149,12 @@ class ModbusMasterTCP:
                 # conflict, server and client updated same value
                 # shift memory, update memory
                 self.buffered_memory.set_value(i, mem_value)
-                self.memory.set_value(i, server_value)
+                self.memory.set_value(i, server_value, mark_dirty=False)
             elif server_value != mem_value and mem_value == buf_value:
                 # no conflict, server updated, client did not
                 # read from server
                 self.buffered_memory.set_value(i, server_value)
-                self.memory.set_value(i, server_value)
+                self.memory.set_value(i, server_value, mark_dirty=False)
             elif server_value == buf_value and mem_value != buf_value:
                 # no conflict, client updated, server did not
                 # write to the server
@@ -163,34 +1170,123 @@ class ModbusMasterTCP:
             yield last_idx, next_idx
             last_idx = next_idx
             if next_idx == t_len:
-                raise StopIteration
+                return
 
     def _log(self, message):
         with open("client_log.log", "a") as f:
             f.write("{0}:\t{1}\n".format(datetime.now().strftime("%x %X"), message))
 
+    def _sync_region(self, region, woken):
+        t0 = region.last = time()
+        if region.area != 'holding_registers':
+            result = self.do_map_area(region.area, address=region.address, count=region.count)
+        elif self.sync_mode == 'dirty':
+            result = self.do_map_dirty(address=region.address, count=region.count)
+        elif self.sync_mode == 'fc23':
+            result = self.do_map_fc23(address=region.address, count=region.count)
+        else:
+            result = self.do_map2(address=region.address, count=region.count)
+        t1 = time()
+
+        stats = self.stats
+        stats['cycles'] += 1
+        stats['last_duration'] = t1 - t0
+        stats['max_duration'] = max(stats['max_duration'], t1 - t0)
+        if self.metrics is not None:
+            self.metrics.observe('master_sync_seconds', t1 - t0)
+        if woken:
+            stats['wakeups'] += 1
+        else:
+            jitter = max(0.0, t0 - region.due)
+            stats['total_jitter'] += jitter
+            stats['max_jitter'] = max(stats['max_jitter'], jitter)
+
+        # back off while nothing changes on either side
+        if result.memory_ranges or result.client_ranges:
+            region.interval = region.period
+        else:
+            stats['idle_cycles'] += 1
+            if region.max_period is not None:
+                region.interval = min(2*region.interval, region.max_period)
+
+        if t1 - t0 > region.interval:
+            stats['overruns'] += 1
+            if self.metrics is not None:
+                self.metrics.inc('master_overruns_total')
+            self._log("Sync period exceeded. Data transfer takes longer [{}s] than required synchronization time [{}s]. Consider truncating memory or elongating sync_period." \
+                .format((t1-t0), region.interval))
+        # late cycles are not caught up in a burst
+        region.due = max(t0 + region.interval, t1)
+
     def _start(self):
         # should be started in another thread
         self.keep_running = True
+        self._killed.clear()
+        # by default whole memory is synchronized, each area as a single region
+        regions = self.regions or [
+            _SyncRegion(0, self.memory.get_area_size(area), self.sync_period, self.max_period, area)
+            for area in ('holding_registers', 'coils', 'discrete_inputs', 'input_registers')
+            if self.memory.get_area_size(area)]
+        for region in regions:
+            region.due = time()
+        # memory is stale until this master synchronizes, also when other masters share it
+        self.memory.set_stale(id(self))
+        written = self.wake_on_write and self.memory.wait_dirty(0)
+        failures = 0
         try:
             while self.keep_running:
-                t0 = time()
-                self.do_map2()
-                t1 = time()
                 try:
-                    sleep(self.sync_period-(t1-t0))
-                except ValueError:
-                    self._log("Sync period exceeded. Data transfer takes longer [{}s] than required synchronization time [{}s]. Consider truncating memory or elongating sync_period." \
-                        .format((t1-t0), self.sync_period))
+                    now = time()
+                    woken = []
+                    if written:
+                        dirty_ranges = {'holding_registers': self.memory.get_dirty_ranges(),
+                                        'coils': self.memory.get_dirty_ranges('coils')}
+                        for region in regions:
+                            if region.overlaps(dirty_ranges.get(region.area, ())):
+                                wake_at = region.last + self.wake_period
+                                if wake_at <= now:
+                                    woken.append(region)
+                                else:
+                                    # rate limited, synchronized when wake_period is over
+                                    region.due = min(region.due, wake_at)
+
+                    for region in regions:
+                        if region in woken or region.due <= now:
+                            self._sync_region(region, region in woken and region.due > now)
+                            self.memory.set_synced(id(self))
+                            failures = 0
+
+                except ConnectionError as e:
+                    self.memory.set_stale(id(self))
+                    self.stats['connection_errors'] += 1
+                    if self.metrics is not None:
+                        self.metrics.inc('master_connection_errors_total')
+                    if not self.reconnect:
+                        break
+                    # exponential back off, interrupted by kill
+                    delay = min(self.reconnect_delay * 2**failures, self.max_reconnect_delay)
+                    failures += 1
+                    self._log("{} Reconnecting in {}s.".format(e, delay))
+                    self._killed.wait(delay)
+                    written = self.wake_on_write
+                    continue
+
+                timeout = max(0.0, min(region.due for region in regions) - time())
+                if self.wake_on_write:
+                    # returns at once if registers were written during synchronization
+                    written = self.memory.wait_dirty(timeout)
+                else:
+                    sleep(timeout)
 
-        except ConnectionResetError:
-            pass
         finally:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-    
+            # shared socket is closed by its pool
+            if self.connection is None:
+                with self.socket_lock:
+                    self._disconnect()
+
     def kill(self):
         self.keep_running = False
+        self._killed.set()
     
     def run(self):
         th = threading.Thread(group=None, target=self._start, daemon=True)
@@ -0,0 +1,118 @@
+import struct
+from umodbus.exceptions import error_code_to_exception_map
+
+# whole ADUs of supported requests, MBAP header included, registers are big endian on the wire
+MBAP_HEADER = struct.Struct('>HHHB')
+_REQUEST = struct.Struct('>HHHBBHH')              # read registers (3, 4), write single register (6)
+_WRITE_MULTIPLE_HEADER = struct.Struct('>HHHBBHHB')
+_RESPONSE_HEADER = struct.Struct('>HHHBBB')       # MBAP header, function code, byte count or error code
+
+# largest ADU allowed by modbus TCP
+MAX_ADU_SIZE = 260
+
+_word_structs = {}
+
+
+def words_struct(count):
+    # precompiled struct of count big endian registers
+    fmt = _word_structs.get(count)
+    if fmt is None:
+        fmt = _word_structs[count] = struct.Struct('>{}H'.format(count))
+    return fmt
+
+
+def recv_into_exactly(sock, view, count):
+    """
+    Fill view[:count] from socket, without allocating
+    :param sock: connected socket
+    :param view: writable memoryview of bytes, at least count long
+    :param count: number of bytes to receive
+    :raises ValueError: when peer closed connection before count bytes were received
+    """
+    received = 0
+    while received < count:
+        size = sock.recv_into(view[received:count])
+        if not size:
+            raise ValueError("connection closed after {} of {} bytes".format(received, count))
+        received += size
+
+
+class FrameCodec:
+
+    def __init__(self):
+        """
+        Lean MBAP framing of functions 3, 4, 6 and 16 for a master talking to one socket, one request
+        at a time. Requests are packed into a reused send buffer and responses received into a reused
+        receive buffer, register payloads are copied from it straight into the caller's buffer.
+        Not thread safe, owner serializes exchanges, eg. by its socket lock.
+        :return: FrameCodec instance
+        """
+        self._send = bytearray(MAX_ADU_SIZE)
+        self._send_view = memoryview(self._send)
+        self._recv = bytearray(MAX_ADU_SIZE)
+        self._recv_view = memoryview(self._recv)
+        self.transaction_id = 0
+
+    def _next_transaction_id(self):
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        return self.transaction_id
+
+    def _receive(self, sock, transaction_id, function_code):
+        # response into receive buffer, returns its length, late answers to previous requests are skipped
+        view = self._recv_view
+        while True:
+            recv_into_exactly(sock, view, 9)
+            response_id, _, length, _, response_code, byte_count = _RESPONSE_HEADER.unpack_from(self._recv)
+            if not 3 <= length <= MAX_ADU_SIZE - 6:
+                raise ValueError("invalid length {} of response".format(length))
+            recv_into_exactly(sock, view[9:], length - 3)
+            if response_id == transaction_id:
+                break
+
+        if response_code != function_code:
+            if response_code == function_code | 0x80 and byte_count in error_code_to_exception_map:
+                raise error_code_to_exception_map[byte_count]
+            raise ValueError("unexpected function code {} in response".format(response_code))
+        return length + 6
+
+    def read_registers(self, sock, slave_id, function_code, address, count, buffer, offset=0):
+        """
+        Read registers (function 3 or 4) into buffer, as big endian words
+        :param sock: connected socket
+        :param buffer: writable memoryview of bytes receiving 2*count bytes
+        :param offset: position in buffer, in bytes
+        :return: size of request and response, in bytes
+        """
+        transaction_id = self._next_transaction_id()
+        _REQUEST.pack_into(self._send, 0, transaction_id, 0, 6, slave_id, function_code, address, count)
+        sock.sendall(self._send_view[:12])
+
+        size = self._receive(sock, transaction_id, function_code)
+        if self._recv[8] != 2*count or size != 9 + 2*count:
+            raise ValueError("response of {} registers expected".format(count))
+        buffer[offset:offset + 2*count] = self._recv_view[9:size]
+        return 12, size
+
+    def write_register(self, sock, slave_id, address, value):
+        """
+        Write single register, function 6
+        :return: size of request and response, in bytes
+        """
+        transaction_id = self._next_transaction_id()
+        _REQUEST.pack_into(self._send, 0, transaction_id, 0, 6, slave_id, 6, address, value)
+        sock.sendall(self._send_view[:12])
+        return 12, self._receive(sock, transaction_id, 6)
+
+    def write_registers(self, sock, slave_id, address, values):
+        """
+        Write up to 123 registers, function 16
+        :param values: sequence of words
+        :return: size of request and response, in bytes
+        """
+        count = len(values)
+        transaction_id = self._next_transaction_id()
+        _WRITE_MULTIPLE_HEADER.pack_into(self._send, 0, transaction_id, 0, 7 + 2*count, slave_id, 16, address,
+                                         count, 2*count)
+        words_struct(count).pack_into(self._send, 13, *values)
+        sock.sendall(self._send_view[:13 + 2*count])
+        return 13 + 2*count, self._receive(sock, transaction_id, 16)
@@ -0,0 +1,278 @@
+import socket
+import threading
+from array import array
+from umodbus.exceptions import GatewayTargetDeviceFailedToRespondError, IllegalDataAddressError
+from umodbus.utils import pack_exception_pdu
+from ModbusSharedMemory.memory import MemoryStore
+from ModbusSharedMemory.client_server import ModbusMasterTCP, ModbusSlaveTCP, open_socket
+
+
+class PooledConnection:
+
+    def __init__(self, host, port, timeout=5.0, keepalive=True):
+        """
+        Persistent socket shared by masters talking to the same slave device, or to a gateway
+        serving several unit ids. Whole exchanges (request batches) are serialized by lock.
+        Socket is opened on first use and reopened after it is dropped by a master.
+        :param host: address of modbus slave
+        :param port: TCP port of modbus slave
+        :param timeout: socket timeout, in seconds, see client_server.open_socket
+        :param keepalive: enable TCP keepalive
+        :return: PooledConnection instance
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.socket = None
+        self.lock = threading.RLock()
+
+    def get_socket(self):
+        with self.lock:
+            if self.socket is None:
+                self.socket = open_socket(self.host, self.port, self.timeout, self.keepalive)
+            return self.socket
+
+    def drop(self, sock):
+        # close broken socket, unless it was already replaced
+        with self.lock:
+            if sock is not None and sock is self.socket:
+                self.close()
+
+    def close(self):
+        with self.lock:
+            if self.socket is None:
+                return
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+            self.socket = None
+
+
+class ConnectionPool:
+
+    def __init__(self, timeout=5.0, keepalive=True):
+        """
+        One persistent connection per (host, port), created on first use
+        :param timeout: socket timeout of connections, in seconds
+        :param keepalive: enable TCP keepalive on connections
+        :return: ConnectionPool instance
+        """
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port=502):
+        with self._lock:
+            connection = self._connections.get((host, port))
+            if connection is None:
+                connection = PooledConnection(host, port, self.timeout, self.keepalive)
+                self._connections[(host, port)] = connection
+            return connection
+
+    def get_connections(self):
+        with self._lock:
+            return list(self._connections.values())
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+class ModbusGateway:
+
+    def __init__(self, sync_period=0.2, sync_mode='full', pipeline_depth=1, max_period=None, pool=None, metrics=None):
+        """
+        Poller of many modbus sources (host, port, unit id, address range), each mapped into a region
+        of a MemoryStore. Sources on the same host and port share one pooled connection, unit ids
+        are multiplexed over it, sources are polled concurrently, each by its own master thread.
+        :param sync_period: default time between synchronizations of a source, in seconds
+        :param sync_mode: 'full', 'dirty' or 'fc23', see ModbusMasterTCP
+        :param pipeline_depth: max number of requests in flight per exchange, see ModbusMasterTCP
+        :param max_period: default back off limit of a source, see ModbusMasterTCP
+        :param pool: ConnectionPool to take connections from, new pool when None
+        :param metrics: metrics.Metrics shared by masters of all sources, None disables them
+        :return: ModbusGateway instance
+        """
+        if sync_mode not in ModbusMasterTCP.sync_modes:
+            raise ValueError("sync_mode should be one of {}".format(ModbusMasterTCP.sync_modes))
+
+        self.sync_period = sync_period
+        self.sync_mode = sync_mode
+        self.pipeline_depth = pipeline_depth
+        self.max_period = max_period
+        self.pool = ConnectionPool() if pool is None else pool
+        self.metrics = metrics
+        self.sources = []
+
+    def add_source(self, memory_store, host, port=502, slave_id=1, remote_address=0, count=None, address=0,
+                   period=None, max_period=None):
+        """
+        Map registers of a slave into a region of memory_store
+        :param memory_store: MemoryStore receiving the registers
+        :param host: address of modbus slave
+        :param port: TCP port of modbus slave
+        :param slave_id: unit id of the source
+        :param remote_address: first register of the source, on the slave
+        :param count: number of registers, None for rest of memory_store
+        :param address: first register of the region, in memory_store
+        :param period: time between synchronizations of the source, None for sync_period of gateway
+        :param max_period: back off limit of the source, None for max_period of gateway
+        :return: ModbusMasterTCP synchronizing the source, eg. for its stats
+        """
+        if not isinstance(memory_store, MemoryStore):
+            raise ValueError("memory_store should be instance of MemoryStore")
+
+        count = memory_store.get_size() - address if count is None else count
+        if not (0 <= address and count > 0 and address + count <= memory_store.get_size()):
+            raise ValueError("Size exceeded")
+        if not (0 <= remote_address and remote_address + count <= 0x10000):
+            raise ValueError("remote range should be in range of (0, 65535)")
+
+        for source in self.sources:
+            if source.memory is memory_store and source.regions[0].overlaps([(address, count)]):
+                raise ValueError("source overlaps already added source of the same memory_store")
+
+        period = self.sync_period if period is None else period
+        max_period = self.max_period if max_period is None else max_period
+        master = ModbusMasterTCP(memory_store, host, slave_id, period, self.sync_mode, self.pipeline_depth,
+                                 max_period=max_period, port=port, address_offset=remote_address - address,
+                                 connection=self.pool.get(host, port), metrics=self.metrics)
+        master.add_region(address, count)
+        self.sources.append(master)
+        return master
+
+    def get_stats(self):
+        """
+        :return: list of (host, port, slave_id, stats) tuples, one per source, see ModbusMasterTCP.get_stats
+        """
+        return [(master.connection.host, master.connection.port, master.default_slave_id, master.get_stats())
+                for master in self.sources]
+
+    def kill(self):
+        for master in self.sources:
+            master.kill()
+
+    def close(self):
+        """
+        Stop polling and close pooled connections
+        """
+        self.kill()
+        self.pool.close()
+
+    def run(self):
+        for master in self.sources:
+            master.run()
+
+
+class CachingSlaveTCP(ModbusSlaveTCP):
+
+    def __init__(self, memory_store, max_age=None, **kwargs):
+        """
+        ModbusSlaveTCP serving a memory kept in sync with an upstream device. While memory is stale,
+        ie. upstream connection is lost or last synchronization is older than max_age, every request
+        is answered with gateway target device failed to respond exception instead of outdated values.
+        Writes mark dirty (and wake master) only registers and coils whose value changed, so clients
+        writing back their whole image do not cost upstream requests.
+        :param memory_store: MemoryStore synchronized by upstream master
+        :param max_age: max age of last synchronization, in seconds, None only checks upstream connection
+        :param kwargs: passed to ModbusSlaveTCP
+        :return: CachingSlaveTCP instance
+        """
+        super().__init__(memory_store, **kwargs)
+        self.max_age = max_age
+
+    def execute_pdu(self, slave_id, request_pdu):
+        if slave_id == self.slave_id and self.memory.is_stale(self.max_age):
+            return pack_exception_pdu(request_pdu[0], GatewayTargetDeviceFailedToRespondError.error_code)
+        return super().execute_pdu(slave_id, request_pdu)
+
+    def write_holding_regs(self, address, values):
+        if address + len(values) > self.memory.get_size():
+            raise IllegalDataAddressError()
+        values = array('H', values)
+        with self.memory.lock:
+            current = self.memory.get_range(address, len(values))
+            changed = bytearray(old != new for old, new in zip(current, values))
+            for start, count in MemoryStore._find_ranges(changed):
+                self.memory.set_range(address + start, values[start:start + count], notify=True)
+
+    def write_coils(self, address, count, data):
+        if address + count > self.memory.get_area_size('coils'):
+            raise IllegalDataAddressError()
+        value = int.from_bytes(data[:(count + 7) // 8], 'little') & ((1 << count) - 1)
+        with self.memory.lock:
+            diff = value ^ int.from_bytes(self.memory.get_packed_bits('coils', address, count), 'little')
+            changed = bytearray(diff >> idx & 1 for idx in range(count))
+            for start, length in MemoryStore._find_ranges(changed):
+                bits = (value >> start) & ((1 << length) - 1)
+                self.memory.set_packed_bits('coils', address + start, length,
+                                            bits.to_bytes((length + 7) // 8, 'little'), notify=True)
+
+
+class ModbusProxy:
+
+    def __init__(self, memory_store, upstream_ip, upstream_port=502, upstream_slave_id=1, server_ip='localhost',
+                 port=502, slave_id=1, sync_period=0.2, sync_mode='dirty', max_period=None, max_age=None,
+                 max_connections=None, metrics=None, **master_kwargs):
+        """
+        Caching fan-out proxy: one master polls upstream device into memory_store, a concurrent slave
+        serves the same store to any number of downstream masters, so upstream load does not depend
+        on number of clients. Reads are answered from memory, see CachingSlaveTCP for max_age.
+        Downstream writes mark changed registers and coils dirty, master forwards them on its next cycle,
+        woken by the write but at most once per sync_period: writes made between two cycles are coalesced
+        into blocks, sent in address order, last write of a register wins. Stale cache is never served,
+        see CachingSlaveTCP.
+        :param memory_store: MemoryStore cache, sized as the upstream block
+        :param upstream_ip: address of upstream slave
+        :param upstream_port: TCP port of upstream slave
+        :param upstream_slave_id: unit id of upstream slave
+        :param server_ip: address to listen on for downstream masters
+        :param port: TCP port to listen on
+        :param slave_id: unit id answered downstream
+        :param sync_period: time between synchronizations with upstream, in seconds
+        :param sync_mode: 'dirty' (upstream wins conflicting writes) or 'fc23' (downstream writes win), see ModbusMasterTCP
+        :param max_period: back off limit of upstream polling, see ModbusMasterTCP
+        :param max_age: max age of cached data served downstream, in seconds, should not be shorter
+                        than max_period (or sync_period), None only checks upstream connection
+        :param max_connections: limit of downstream connections, None for no limit
+        :param metrics: metrics.Metrics shared by master and slave, None disables them
+        :param master_kwargs: passed to upstream ModbusMasterTCP, eg. timeout or fast_codec, wake_period
+                              defaults to sync_period
+        :return: ModbusProxy instance
+        """
+        if sync_mode not in ('dirty', 'fc23'):
+            raise ValueError("sync_mode should be one of {}".format({'dirty', 'fc23'}))
+
+        if max_age is not None and max_age < (sync_period if max_period is None else max_period):
+            raise ValueError("max_age should not be shorter than max_period (or sync_period)")
+
+        self.memory = memory_store
+        master_kwargs.setdefault('wake_period', sync_period)
+        self.master = ModbusMasterTCP(memory_store, upstream_ip, upstream_slave_id, sync_period, sync_mode,
+                                      max_period=max_period, wake_on_write=True, port=upstream_port,
+                                      metrics=metrics, **master_kwargs)
+        self.slave = CachingSlaveTCP(memory_store, max_age, server_ip=server_ip, slave_id=slave_id, concurrent=True,
+                                     max_connections=max_connections, port=port, metrics=metrics)
+
+    def get_stats(self):
+        """
+        :return: dict with upstream master stats (see ModbusMasterTCP.get_stats) and number of
+                 downstream 'connections'
+        """
+        stats = self.master.get_stats()
+        stats['connections'] = self.slave.app.connections
+        return stats
+
+    def run(self):
+        self.master.run()
+        self.slave.run()
+
+    def kill(self):
+        self.slave.kill()
+        self.master.kill()
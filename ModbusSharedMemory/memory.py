@@ -1,19 +1,62 @@
 from copy import deepcopy
 from time import sleep, time
 from math import log10
-from collections import defaultdict
+from array import array
+from threading import RLock, Event, get_ident
+from contextlib import contextmanager
+import struct
+import sys
+import os
+import tempfile
+from collections import namedtuple
+
+try:
+    from multiprocessing import shared_memory, resource_tracker, parent_process
+except ImportError:
+    shared_memory = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # eg. windows
+
+# memory areas of MemoryStore, with names of sequences used in compiled decoders
+REGISTER_AREAS = {'holding_registers': 'w', 'input_registers': 'i'}
+BIT_AREAS = {'coils': 'c', 'discrete_inputs': 'd'}
+AREAS = dict(REGISTER_AREAS, **BIT_AREAS)
+
+# data directions of holding registers, seen from master: 'read' slave to master only (eg. status),
+# 'write' master to slave only (eg. setpoints), 'both' merged both ways
+DIRECTIONS = ('both', 'read', 'write')
+
+# struct format characters of types decoded in bulk, 'string' elements are '<n>s'
+STRUCT_FORMATS = {'word': 'H', 'uint32': 'I', 'int16': 'h', 'int32': 'i', 'int64': 'q', 'uint64': 'Q',
+                  'float32': 'f', 'float64': 'd'}
+
 
 class MemoryVariable:
-    allowed_types = {'bool', 'byte', 'word', 'uint32'}
-    type_sizes = {'bool': 1, 'byte': 8, 'word': 16, 'uint32': 32} # size in bits
+    allowed_types = {'bool', 'byte', 'word', 'uint32', 'bit', 'int16', 'int32', 'int64', 'uint64',
+                     'float32', 'float64', 'string'}
+    type_sizes = {'bool': 1, 'byte': 8, 'word': 16, 'uint32': 32, 'bit': 1, 'int16': 16, 'int32': 32,
+                  'int64': 64, 'uint64': 64, 'float32': 32, 'float64': 64} # size in bits, 'string' depends on length
+    byte_orders = {'big', 'little'}
 
-    def __init__(self, address, bit_number=None, byte_number=None, var_type='word'):
+    def __init__(self, address, bit_number=None, byte_number=None, var_type='word', area='holding_registers',
+                 count=None, length=None, byte_order='big', word_order='little'):
         """
         User for storing named variables in MemoryStrore
-        :param address: address of variable in memory, in words (double byte)
-        :param var_type: type of variable, should be one of {'bool', 'byte', 'word', 'uint32'}
+        :param address: address of variable in memory, in words (double byte), in bits for 'bit' type
+        :param var_type: type of variable, should be one of {'bool', 'byte', 'word', 'uint32', 'bit', 'int16',
+                         'int32', 'int64', 'uint64', 'float32', 'float64', 'string'}
         :param bit_number: number of bit, in range (0..15), should be None fo variables other than 'bool'
         :param byte_number: number of byte, should be one of (0, 1) for variable type 'byte', None otherwise
+        :param area: memory area of variable, 'holding_registers' or 'input_registers' for register types,
+                     'coils' or 'discrete_inputs' for 'bit' type
+        :param count: number of elements of fixed-length array variable, value is then a list, None for scalar
+        :param length: length of 'string' variable, in characters (bytes), None for other types
+        :param byte_order: order of bytes in register, 'big' (high byte first, as in modbus frames) or 'little'
+        :param word_order: order of registers of multi register values, 'little' (least significant word first,
+                           as 'uint32' always was) or 'big'
         :return: MemoryVariable instance
         """
         
@@ -21,15 +64,43 @@ class MemoryVariable:
         if var_type not in MemoryVariable.allowed_types:
             raise ValueError("var_type should be one of {}".format(MemoryVariable.allowed_types))
 
+        if byte_order not in MemoryVariable.byte_orders or word_order not in MemoryVariable.byte_orders:
+            raise ValueError("byte_order and word_order should be one of {}".format(MemoryVariable.byte_orders))
+
+        if var_type in ('bool', 'byte', 'bit'):
+            # parts of a word (or single bits) are not packed
+            if count is not None or byte_order != 'big' or word_order != 'little':
+                raise ValueError("For '{}' var_type, count, byte_order and word_order can not be set".format(var_type))
+
+        if count is not None and (not isinstance(count, int) or count < 1):
+            raise ValueError("count should be a positive integer or None")
+
+        if (var_type == 'string') != (length is not None):
+            raise ValueError("length should be given for 'string' var_type only")
+
+        if var_type == 'string' and (not isinstance(length, int) or length < 1):
+            raise ValueError("length should be a positive integer")
+
+        if area not in AREAS:
+            raise ValueError("area should be one of {}".format(set(AREAS)))
+
+        if (var_type == 'bit') != (area in BIT_AREAS):
+            raise ValueError("'bit' var_type should be used for areas {} only".format(set(BIT_AREAS)))
+
+        if var_type == 'bit':
+            # single coil or discrete input
+            if bit_number is not None or byte_number is not None:
+                raise ValueError("For 'bit' var_type, bit_number and byte_number should be None")
+
         if var_type == 'word':
             # bit number and byte_number should be none
             if bit_number is not None or byte_number is not None:
                 raise ValueError("For 'word' var_type, bit_number and byte_number should be None")
         
-        elif var_type == 'uint32':
+        elif var_type in STRUCT_FORMATS or var_type == 'string':
             # bit and byte number should be none
             if bit_number is not None or byte_number is not None:
-                raise ValueError("For 'uint32' var_type, bit_number and byte_number should be None")
+                raise ValueError("For '{}' var_type, bit_number and byte_number should be None".format(var_type))
         
         elif var_type == 'bool':
             # bit_number should be in range of (0..15) and byte_number should be None
@@ -52,39 +123,152 @@ class MemoryVariable:
         self.bit_number = bit_number
         self.byte_number = byte_number
         self.address = address
+        self.area = area
+        self.count = count
+        self.length = length
+        self.byte_order = byte_order
+        self.word_order = word_order
+        self._codec = self._get_codec()
+
+    def _get_codec(self):
+        # arguments of _decode_words and _encode_words, None for types decoded by plain expressions
+        if self.type not in STRUCT_FORMATS and self.type != 'string':
+            return None
+        if self.type in ('word', 'uint32') and self.count is None and self.byte_order == 'big' \
+                and self.word_order == 'little':
+            return None
+
+        if self.type == 'string':
+            step = (self.length + 1) // 2
+            element = '{}s'.format(2*step)
+            kind = 'string' if self.count is None else 'strings'
+        else:
+            step = MemoryVariable.type_sizes[self.type] // 16
+            element = STRUCT_FORMATS[self.type]
+            kind = 'scalar' if self.count is None else 'array'
+        count = 1 if self.count is None else self.count
+        fmt = '>' + (element * count if self.type == 'string' else '{}{}'.format(count, element))
+        # registers are brought to big endian order, most significant word first, before unpacking
+        reverse = self.word_order == 'little' and step > 1 and self.type != 'string'
+        swap = (sys.byteorder == 'little') == (self.byte_order == 'big')
+        return fmt, step, reverse, swap, kind
     
     @classmethod
-    def bool(cls, address, bit_number):
-        return cls(address=address, var_type='bool', bit_number=bit_number, byte_number=None)
+    def bool(cls, address, bit_number, area='holding_registers'):
+        return cls(address=address, var_type='bool', bit_number=bit_number, byte_number=None, area=area)
     
     @classmethod
-    def byte(cls, address, byte_number):
-        return cls(address=address, var_type='byte', bit_number=None, byte_number=byte_number)
+    def byte(cls, address, byte_number, area='holding_registers'):
+        return cls(address=address, var_type='byte', bit_number=None, byte_number=byte_number, area=area)
+
+    @classmethod
+    def word(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='word', bit_number=None, byte_number=None, area=area, **kwargs)
+
+    @classmethod
+    def uint32(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='uint32', bit_number=None, byte_number=None, area=area, **kwargs)
+
+    @classmethod
+    def int16(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='int16', area=area, **kwargs)
 
     @classmethod
-    def word(cls, address):
-        return cls(address=address, var_type='word', bit_number=None, byte_number=None)
+    def int32(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='int32', area=area, **kwargs)
 
     @classmethod
-    def uint32(cls, address):
-        return cls(address=address, var_type='uint32', bit_number=None, byte_number=None)
+    def int64(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='int64', area=area, **kwargs)
+
+    @classmethod
+    def uint64(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='uint64', area=area, **kwargs)
+
+    @classmethod
+    def float32(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='float32', area=area, **kwargs)
+
+    @classmethod
+    def float64(cls, address, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='float64', area=area, **kwargs)
+
+    @classmethod
+    def string(cls, address, length, area='holding_registers', **kwargs):
+        return cls(address=address, var_type='string', length=length, area=area, **kwargs)
+
+    @classmethod
+    def coil(cls, address):
+        return cls(address=address, var_type='bit', area='coils')
+
+    @classmethod
+    def discrete_input(cls, address):
+        return cls(address=address, var_type='bit', area='discrete_inputs')
+
+    def get_word_count(self):
+        # number of memory words (bits for 'bit' type) occupied by variable
+        if self.type == 'string':
+            words = (self.length + 1) // 2
+        else:
+            words = max(1, MemoryVariable.type_sizes[self.type] // 16)
+        return words if self.count is None else words * self.count
+
+    def get_expression(self, words='w'):
+        """
+        Python expression decoding variable from a sequence of words, used to compile memory layout
+        :param words: name of sequence holding memory words
+        :return: expression string
+        """
+        if self._codec is not None:
+            # whole block is sliced and unpacked at once
+            return "_decode_words({0}[{1}:{2}], {3})".format(
+                words, self.address, self.address + self.get_word_count(), ", ".join(map(repr, self._codec)))
+        elif self.type == 'bit':
+            # bits are packed, least significant bit first, as in modbus frames
+            return "bool({0}[{1}] & {2})".format(words, self.address >> 3, 1 << (self.address & 7))
+        elif self.type == 'bool':
+            return "bool({0}[{1}] & {2})".format(words, self.address, 1 << self.bit_number)
+        elif self.type == 'byte':
+            return "(({0}[{1}] >> {2}) & 255)".format(words, self.address, self.byte_number*8)
+        elif self.type == 'word':
+            return "{0}[{1}]".format(words, self.address)
+        elif self.type == 'uint32':
+            return "({0}[{1}] | ({0}[{2}] << 16))".format(words, self.address, self.address + 1)
 
     def build_value_stack(self, value, memory_instance):
         if not isinstance(memory_instance, MemoryStore):
             raise ValueError("memory_instance should be instance of MemoryStore")
 
-        if self.type == 'bool':
+        return self.encode(value, memory_instance.get_value)
+
+    def encode(self, value, get_word):
+        """
+        Validate value and build words to be written, starting at variable address
+        :param value: new value of variable
+        :param get_word: function returning current word at given address, for bool and byte types
+        :return: tuple of words, tuple with one bit for 'bit' type
+        """
+        if self._codec is not None:
+            return _encode_words(value, self.count, self.length, *self._codec)
+
+        elif self.type == 'bit':
+            if not isinstance(value, bool):
+                raise ValueError("Value should be bool type")
+
+            return (value, )
+
+        elif self.type == 'bool':
             if not isinstance(value, bool):
                 raise ValueError("Value should be bool type")
 
-            number = memory_instance.get_value(self.address)
+            number = get_word(self.address)
             mask = 1 << self.bit_number
             return ((number & ~mask) | ((1*value << self.bit_number) & mask), )
         
         elif self.type == 'byte':
             if not 0 <= value <= 255:
                 raise ValueError("value for 'byte' type should be in range of (0, 255)")
-            old_value_mask = memory_instance.get_value(self.address) & (0b1111111100000000 >> self.byte_number*8)
+            old_value_mask = get_word(self.address) & (0b1111111100000000 >> self.byte_number*8)
             return ((value << self.byte_number*8) | old_value_mask, )
         
         elif self.type == 'word':
@@ -99,11 +283,42 @@ class MemoryVariable:
 
             return (65535 & value, value >> 16)
     
+    def decode_words(self, words):
+        """
+        Decode variable from its own words, eg. a block copied from memory
+        :param words: sequence of get_word_count() words, starting at variable address
+        :return: value of variable
+        """
+        if self._codec is not None:
+            return _decode_words(words, *self._codec)
+        elif self.type == 'bool':
+            return bool(words[0] & (1 << self.bit_number))
+        elif self.type == 'byte':
+            return (words[0] >> self.byte_number*8) & 255
+        elif self.type == 'word':
+            return words[0]
+        elif self.type == 'uint32':
+            return words[0] | (words[1] << 16)
+        raise ValueError("'{}' var_type is not stored in words".format(self.type))
+
     def get_memory_value(self, memory_instance):
         if not isinstance(memory_instance, MemoryStore):
             raise ValueError("memory_instance should be instance of MemoryStore")
-        
-        if self.type == 'bool':
+
+        if self.type == 'bit':
+            return memory_instance.get_bits(self.area, self.address, 1)[0]
+
+        elif self._codec is not None:
+            if self.area == 'input_registers':
+                words = memory_instance.get_input_range(self.address, self.get_word_count())
+            else:
+                words = memory_instance.get_range(self.address, self.get_word_count())
+            return _decode_words(words, *self._codec)
+
+        elif self.area == 'input_registers':
+            return self.decode_words(memory_instance.get_input_range(self.address, self.get_word_count()))
+
+        elif self.type == 'bool':
             mask = 1 << self.bit_number
             return bool(mask & memory_instance.get_value(self.address))
         
@@ -119,64 +334,925 @@ class MemoryVariable:
             msw = memory_instance.get_value(self.address + 1)
             return lsw | (msw << 16) 
 
+
+def _decode_words(words, fmt, step, reverse, swap, kind):
+    # unpack block of registers of variable at once, see MemoryVariable._get_codec
+    words = array('H', words) if reverse or not isinstance(words, array) else words
+    if reverse:
+        # most significant word first, in every element
+        ordered = array('H', words)
+        for idx in range(step):
+            ordered[idx::step] = words[step - 1 - idx::step]
+        words = ordered
+    if swap:
+        words.byteswap()
+    values = struct.unpack(fmt, words.tobytes())
+    if kind == 'scalar':
+        return values[0]
+    elif kind == 'array':
+        return list(values)
+    elif kind == 'string':
+        return values[0].split(b'\x00', 1)[0].decode('latin-1')
+    return [value.split(b'\x00', 1)[0].decode('latin-1') for value in values]
+
+
+def _encode_words(value, count, length, fmt, step, reverse, swap, kind):
+    # inverse of _decode_words, returns tuple of registers
+    values = [value] if count is None else list(value)
+    if len(values) != (1 if count is None else count):
+        raise ValueError("value should be a sequence of {} elements".format(count))
+    if kind in ('string', 'strings'):
+        try:
+            values = [element.encode('latin-1') for element in values]
+        except (AttributeError, UnicodeEncodeError):
+            raise ValueError("value should be a latin-1 string")
+        if any(len(element) > length for element in values):
+            raise ValueError("string should be at most {} characters long".format(length))
+    try:
+        data = struct.pack(fmt, *values)
+    except (struct.error, OverflowError):
+        raise ValueError("value {} does not fit in {}".format(value, fmt))
+
+    words = array('H')
+    words.frombytes(data)
+    if swap:
+        words.byteswap()
+    if reverse:
+        ordered = array('H', words)
+        for idx in range(step):
+            ordered[idx::step] = words[step - 1 - idx::step]
+        words = ordered
+    return tuple(words)
+
+
+class _StagedWords(dict):
+    # words written in transaction, falls back to memory for others
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.areas = {} # (area, address) -> word or bit, for areas other than holding registers
+
+    def __missing__(self, address):
+        return self.store[address]
+
+    def __getitem__(self, key):
+        # slices are used by decoders of multi register types
+        if isinstance(key, slice):
+            return array('H', [self[address] for address in range(key.start, key.stop)])
+        return super().__getitem__(key)
+
+
 class MemoryStore:
-    def __init__(self, size):
-        self._store = defaultdict(lambda: 0)
+    # dirty flags of areas written by both sides, by area
+    _dirty_flags = {'holding_registers': '_dirty', 'coils': '_coils_dirty'}
+
+    def __init__(self, size, coils=0, discrete_inputs=0, input_registers=0):
+        """
+        Contiguous block of 16 bit registers, backed by an array('H'), holding registers are
+        served and synchronized by default. Other modbus areas are optional, bit areas are packed
+        eight bits per byte.
+        :param size: size of memory, in words (double byte)
+        :param coils: number of coils (read/write bits)
+        :param discrete_inputs: number of discrete inputs (bits read by master)
+        :param input_registers: number of input registers (words read by master)
+        :return: MemoryStore instance
+        """
+        self._store = array('H', bytes(2*size))
+        self._dirty = bytearray(size) # one flag per register, set on local writes
         self._size = size
+        self._init_areas(coils, discrete_inputs, input_registers)
+        self.lock = RLock() # held by writers, servers and sync engines for multi register consistency
+        self._dirty_event = Event() # set when registers are marked dirty, see wait_dirty
+        self._last_syncs = {} # source -> time of last successful synchronization, None before first one
+        self._stale_sources = set() # sources with lost connection, see is_stale
+        self._init_variables()
+
+    def _init_areas(self, coils, discrete_inputs, input_registers):
+        self._areas = {
+            'holding_registers': self._store,
+            'input_registers': array('H', bytes(2*input_registers)),
+            'coils': bytearray((coils + 7) // 8),
+            'discrete_inputs': bytearray((discrete_inputs + 7) // 8),
+        }
+        self._area_sizes = {'holding_registers': self._size, 'input_registers': input_registers,
+                            'coils': coils, 'discrete_inputs': discrete_inputs}
+        self._coils_dirty = bytearray(coils) # one flag per coil, set on local writes
+        self._direction_runs = [(0, self._size, 'both')] if self._size else [] # (address, count, direction)
+
+    def _init_variables(self):
+        self._variables = {} # name -> MemoryVariable
+        self._decoders = {}  # name -> compiled decoder of single variable
+        self._layout = None  # compiled snapshot of all variables, built on demand
+        self._transactions = {} # thread ident -> staged words of open transaction
+        self._subscriptions = {} # name -> list of change callbacks
 
     def get_value(self, address):
-        if 0 > address > self._size:
+        if not 0 <= address < self._size:
             raise ValueError("Size exceeded")
         
         return self._store[address]
     
-    def set_value(self, address, value):
-        if 0 > address > self._size:
+    def set_value(self, address, value, mark_dirty=True):
+        if not 0 <= address < self._size:
+            raise ValueError("Size exceeded")
+        with self.lock:
+            try:
+                self._store[address] = value
+            except OverflowError:
+                raise ValueError("value should be in range of (0, 65535)")
+            if mark_dirty:
+                self._dirty[address] = 1
+                if not self._dirty_event.is_set():
+                    self._dirty_event.set()
+
+    def get_range(self, address, count):
+        """
+        Bulk read of consecutive registers
+        :param address: starting address, in words
+        :param count: number of words to read
+        :return: array('H') copy of the requested block
+        """
+        if not (0 <= address and count >= 0 and address + count <= self._size):
             raise ValueError("Size exceeded")
-        self._store[address] = value
+
+        return self._store[address:address + count]
+
+    def set_range(self, address, values, mark_dirty=True, notify=False):
+        """
+        Bulk write of consecutive registers
+        :param address: starting address, in words
+        :param values: iterable of words (array('H') is copied without conversion)
+        :param mark_dirty: whether written registers should be reported by get_dirty_ranges
+        :param notify: fire subscriptions of variables changed by this write, used for writes made by peer
+        """
+        if not isinstance(values, array) or values.typecode != 'H':
+            try:
+                values = array('H', values)
+            except OverflowError:
+                raise ValueError("values should be in range of (0, 65535)")
+
+        if not (0 <= address and address + len(values) <= self._size):
+            raise ValueError("Size exceeded")
+
+        with self.lock:
+            watched = self._get_watched(address, len(values)) if notify and self._subscriptions else None
+            self._store[address:address + len(values)] = values
+            if mark_dirty:
+                self._dirty[address:address + len(values)] = b'\x01' * len(values)
+                if not self._dirty_event.is_set():
+                    self._dirty_event.set()
+            if watched:
+                self._notify(watched)
+
+    def mark_dirty(self, address, count=1, area='holding_registers'):
+        """
+        Report registers (or coils) by get_dirty_ranges, as if they were written locally
+        :param area: 'holding_registers' or 'coils'
+        """
+        name = self._get_dirty_flags_name(area)
+        if not (0 <= address and count >= 0 and address + count <= self._area_sizes[area]):
+            raise ValueError("Size exceeded")
+        with self.lock:
+            self.__dict__[name][address:address + count] = b'\x01' * count
+            self._dirty_event.set()
+
+    def _get_dirty_flags_name(self, area):
+        if area not in self._dirty_flags:
+            raise ValueError("area should be one of {}".format(set(self._dirty_flags)))
+        return self._dirty_flags[area]
+
+    def get_dirty_ranges(self, area='holding_registers'):
+        """
+        Registers (or coils) written locally since last pop_dirty_ranges call
+        :param area: 'holding_registers' or 'coils'
+        :return: list of coalesced (address, count) tuples, sorted by address
+        """
+        return self._find_ranges(self.__dict__[self._get_dirty_flags_name(area)])
+
+    def pop_dirty_ranges(self, address=0, count=None, area='holding_registers'):
+        """
+        Same as get_dirty_ranges, but also clears dirty flags
+        :param address: starting address of popped block, in words
+        :param count: number of words in popped block, None for rest of memory
+        :param area: 'holding_registers' or 'coils'
+        :return: list of coalesced (address, count) tuples, sorted by address
+        """
+        name = self._get_dirty_flags_name(area)
+        size = self._area_sizes[area]
+        count = size - address if count is None else count
+        if not (0 <= address and count >= 0 and address + count <= size):
+            raise ValueError("Size exceeded")
+
+        with self.lock:
+            flags = self.__dict__[name]
+            if address == 0 and count == size:
+                self.__dict__[name] = bytearray(size)
+                return self._find_ranges(flags)
+            ranges = self._find_ranges(bytes(flags[address:address + count]))
+            for start, length in ranges:
+                flags[address + start:address + start + length] = bytes(length)
+        return [(address + start, length) for start, length in ranges]
+
+    def wait_dirty(self, timeout=None):
+        """
+        Block until registers are marked dirty, ie. written locally, then reset the wake up.
+        Meant for a single consumer, eg. sync scheduler of master. Writes made by other
+        processes to a SharedMemoryStore do not wake it up.
+        :param timeout: max time to wait, in seconds, None waits forever
+        :return: True if registers were marked dirty since last call, False on timeout
+        """
+        if self._dirty_event.wait(timeout):
+            self._dirty_event.clear()
+            return True
+        return False
+
+    @staticmethod
+    def _find_ranges(flags):
+        # scan for runs of non-zero flags, find() does the heavy lifting in C
+        ranges = []
+        start = flags.find(1)
+        while start != -1:
+            stop = flags.find(0, start)
+            if stop == -1:
+                stop = len(flags)
+            ranges.append((start, stop - start))
+            start = flags.find(1, stop)
+        return ranges
+
+    def get_buffer(self):
+        """
+        Zero-copy view of the whole register block
+        :return: writable memoryview with format 'H', one item per register
+        """
+        return memoryview(self._store)
+
+    def __buffer__(self, flags):
+        # buffer protocol for python >= 3.12, eg. memoryview(memory_store)
+        return memoryview(self._store)
 
     def get_size(self):
         return self._size
 
+    def get_area_size(self, area='holding_registers'):
+        """
+        :param area: one of 'holding_registers', 'input_registers', 'coils', 'discrete_inputs'
+        :return: size of area, in words or bits
+        """
+        if area not in self._area_sizes:
+            raise ValueError("area should be one of {}".format(set(self._area_sizes)))
+        return self._area_sizes[area]
+
+    def _check_bits(self, area, address, count):
+        if area not in BIT_AREAS:
+            raise ValueError("area should be one of {}".format(set(BIT_AREAS)))
+        if not (0 <= address and count >= 0 and address + count <= self._area_sizes[area]):
+            raise ValueError("Size exceeded")
+
+    def get_packed_bits(self, area, address, count):
+        """
+        Bulk read of consecutive coils or discrete inputs
+        :param area: 'coils' or 'discrete_inputs'
+        :param address: first bit
+        :param count: number of bits
+        :return: bytes, first bit in least significant bit of first byte, as in modbus frames
+        """
+        self._check_bits(area, address, count)
+        # bits are shifted in one go, as a single integer
+        chunk = self._areas[area][address >> 3:(address + count + 7) >> 3]
+        value = (int.from_bytes(chunk, 'little') >> (address & 7)) & ((1 << count) - 1)
+        return value.to_bytes((count + 7) // 8, 'little')
+
+    def get_bits(self, area, address, count):
+        """
+        :return: list of bools, see get_packed_bits
+        """
+        value = int.from_bytes(self.get_packed_bits(area, address, count), 'little')
+        return [bool(value >> idx & 1) for idx in range(count)]
+
+    def set_packed_bits(self, area, address, count, data, mark_dirty=True, notify=False):
+        """
+        Bulk write of consecutive coils or discrete inputs
+        :param area: 'coils' or 'discrete_inputs'
+        :param address: first bit
+        :param count: number of bits
+        :param data: bytes-like, packed as in get_packed_bits
+        :param mark_dirty: whether written coils should be reported by get_dirty_ranges
+        :param notify: fire subscriptions of variables changed by this write, used for writes made by peer
+        """
+        self._check_bits(area, address, count)
+        if len(data) < (count + 7) // 8:
+            raise ValueError("data should hold {} bits".format(count))
+
+        start, stop, shift = address >> 3, (address + count + 7) >> 3, address & 7
+        mask = ((1 << count) - 1) << shift
+        value = (int.from_bytes(data[:(count + 7) // 8], 'little') << shift) & mask
+        with self.lock:
+            watched = self._get_watched(address, count, area) if notify and self._subscriptions else None
+            bits = self._areas[area]
+            old_value = int.from_bytes(bits[start:stop], 'little')
+            bits[start:stop] = ((old_value & ~mask) | value).to_bytes(stop - start, 'little')
+            if mark_dirty and area == 'coils':
+                self._coils_dirty[address:address + count] = b'\x01' * count
+                if not self._dirty_event.is_set():
+                    self._dirty_event.set()
+            if watched:
+                self._notify(watched)
+
+    def set_bits(self, area, address, values, mark_dirty=True, notify=False):
+        """
+        :param values: sequence of bools, see set_packed_bits
+        """
+        value = 0
+        for idx, bit in enumerate(values):
+            if bit:
+                value |= 1 << idx
+        count = len(values)
+        self.set_packed_bits(area, address, count, value.to_bytes((count + 7) // 8, 'little'), mark_dirty, notify)
+
+    def get_input_range(self, address, count):
+        """
+        Bulk read of consecutive input registers
+        :return: array('H') copy of the requested block
+        """
+        if not (0 <= address and count >= 0 and address + count <= self._area_sizes['input_registers']):
+            raise ValueError("Size exceeded")
+        with self.lock:
+            return self._areas['input_registers'][address:address + count]
+
+    def set_input_range(self, address, values, notify=False):
+        """
+        Bulk write of consecutive input registers, written by slave side application, read by master
+        :param values: iterable of words
+        :param notify: fire subscriptions of variables changed by this write, used for writes made by peer
+        """
+        try:
+            values = array('H', values)
+        except OverflowError:
+            raise ValueError("values should be in range of (0, 65535)")
+        if not (0 <= address and address + len(values) <= self._area_sizes['input_registers']):
+            raise ValueError("Size exceeded")
+
+        with self.lock:
+            watched = self._get_watched(address, len(values), 'input_registers') if notify and self._subscriptions else None
+            self._areas['input_registers'][address:address + len(values)] = values
+            if watched:
+                self._notify(watched)
+
+    def set_synced(self, source=None):
+        """
+        Record successful synchronization with peer, called by master after each sync cycle
+        :param source: key of synchronizing master, eg. id(master), masters sharing memory use their own
+        """
+        self._last_syncs[source] = time()
+        self._stale_sources.discard(source)
+
+    def set_stale(self, source=None):
+        """
+        Record lost connection to peer, called by master, content is kept but may be outdated
+        :param source: key of master, see set_synced
+        """
+        self._last_syncs.setdefault(source, None)
+        self._stale_sources.add(source)
+
+    def is_stale(self, max_age=None):
+        """
+        Whether content may be outdated: connection of master is lost, memory was not synchronized yet,
+        or, when max_age is given, last successful synchronization is older than max_age.
+        Staleness is kept per source: when several masters synchronize parts of one memory (eg. sources
+        of gateway.ModbusGateway), memory is stale while any of them is, and its age is the age of the
+        oldest synchronization, so a dead source is not hidden by healthy ones.
+        :param max_age: max age of last synchronization, in seconds
+        :return: bool
+        """
+        last_sync = self.get_last_sync()
+        if last_sync is None or self._stale_sources:
+            return True
+        return max_age is not None and time() - last_sync > max_age
+
+    def get_last_sync(self):
+        """
+        :return: time.time() of last successful synchronization, the oldest one of all sources,
+                 None if some source did not synchronize yet
+        """
+        last_syncs = list(self._last_syncs.values())
+        if not last_syncs or None in last_syncs:
+            return None
+        return min(last_syncs)
+
+    def __getstate__(self):
+        # locks and compiled code are not copied, eg. by deepcopy
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['_dirty_event']
+        del state['_decoders']
+        del state['_layout']
+        del state['_transactions']
+        del state['_subscriptions']
+        return state
+
+    def __setstate__(self, state):
+        variables = state.pop('_variables')
+        self.__dict__.update(state)
+        self.__dict__['lock'] = RLock()
+        self.__dict__['_dirty_event'] = Event()
+        self._init_variables()
+        for name, variable in variables.items():
+            setattr(self, name, variable)
+
     def __setattr__(self, name, value):
         # special care for MemoryVariable values
         if isinstance(value, MemoryVariable):
             # 1. Setting for the first time
             # check address
-            if value.address*16 + MemoryVariable.type_sizes[value.type] > 16*self.get_size():
-                raise ValueError("Address {} for type {} exceeds maximum memory size ({}B)".format(value.address, value.type, self.get_size()))
+            area_size = self._area_sizes[value.area]
+            if value.type == 'bit':
+                if not 0 <= value.address < area_size:
+                    raise ValueError("Address {} exceeds size of {} ({})".format(value.address, value.area, area_size))
+            elif value.address < 0 or value.address + value.get_word_count() > area_size:
+                raise ValueError("Address {} for type {} exceeds maximum memory size ({}B)".format(value.address, value.type, area_size))
 
-            # register
-            self.__dict__[name] = value
+            if name in self.__dict__ or hasattr(type(self), name):
+                raise ValueError("Name {} is already used by MemoryStore".format(name))
 
-        elif isinstance(self.__dict__.get(name, None), MemoryVariable):
+            # register and compile decoder, layout is rebuilt on next snapshot
+            self._variables[name] = value
+            if value.area == 'holding_registers':
+                self._decoders[name] = eval("lambda w: " + value.get_expression('w'))
+            else:
+                # decoders of other areas keep their sequence bound, holding registers argument is ignored
+                sequence = AREAS[value.area]
+                self._decoders[name] = eval("lambda w, {0}={0}: {1}".format(sequence, value.get_expression(sequence)),
+                                            {sequence: self._areas[value.area], '_decode_words': _decode_words})
+            self._layout = None
+
+        elif name in self.__dict__.get('_variables', ()):
             # 2. Setting existing memory_value
             # build value and take words from stack
-            stack = self.__dict__[name].build_value_stack(value, self)
-            for idx, word_value in enumerate(stack):
-                self.set_value((self.__dict__[name].address + idx), word_value)
+            variable = self._variables[name]
+            staged = self._transactions.get(get_ident()) if self._transactions else None
+            if variable.area != 'holding_registers':
+                self._set_area_variable(variable, value, staged)
+            elif staged is not None:
+                # inside transaction, bit and byte writes merge into staged words
+                for idx, word_value in enumerate(variable.encode(value, staged.__getitem__)):
+                    staged[variable.address + idx] = word_value
+            else:
+                # multi word variables are never seen half written by sync engine
+                with self._writing():
+                    self.set_range(variable.address, variable.build_value_stack(value, self))
 
         else:
             # ordinary setting
             super().__setattr__(name, value)
 
-    def __getattribute__(self, name):
-        # special care for MemoryVariable values
-        if isinstance(super().__getattribute__("__dict__").get(name, None), MemoryVariable):
-            return self.__dict__[name].get_memory_value(self)
-        
+    def _set_area_variable(self, variable, value, staged=None):
+        area = variable.area
+        if staged is not None:
+            # staged area writes are published together with staged words
+            words = self._areas[area]
+            get_word = lambda address: staged.areas.get((area, address), words[address])
+            for idx, word_value in enumerate(variable.encode(value, get_word)):
+                staged.areas[(area, variable.address + idx)] = word_value
+        elif area == 'input_registers':
+            with self.lock:
+                self.set_input_range(variable.address, variable.encode(value, self._areas[area].__getitem__))
+        else:
+            self.set_bits(area, variable.address, variable.encode(value, None))
+
+    def __getattr__(self, name):
+        # called only if ordinary lookup fails, so ordinary attributes are not slowed down
+        decoder = self.__dict__.get('_decoders', {}).get(name)
+        if decoder is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        if self._transactions:
+            # own staged writes are visible inside transaction
+            staged = self._transactions.get(get_ident())
+            if staged is not None:
+                return decoder(staged)
+        return decoder(self._store)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Stage variable writes of current thread and publish them at once, when block exits without error.
+        Staged words are published under memory lock, so sync engine sees all of them or none,
+        as a single dirty batch. Nested transactions join the outer one.
+        Raw set_value and set_range calls are not staged. Variables of areas other than
+        holding registers are staged too, but read back with their published values.
+
+            with mem.transaction():
+                mem.CURRENT_VALUE = 99999
+                mem.ERROR_STATE = True
+        """
+        ident = get_ident()
+        if ident in self._transactions:
+            yield
+            return
+
+        staged = _StagedWords(self._store)
+        self._transactions[ident] = staged
+        try:
+            yield
+        finally:
+            del self._transactions[ident]
+        self._publish(staged)
+
+    def subscribe(self, name, callback, loop=None):
+        """
+        Watch variable for changes made by peer: values merged by master sync or written to slave.
+        Called only when value of variable changes, so bits and bytes sharing a word are filtered.
+        Callbacks run in thread of sync engine or server, they should be short.
+        :param name: name of MemoryVariable
+        :param callback: callable(name, old_value, new_value), or queue with put_nowait method
+                         (queue.Queue, asyncio.Queue) receiving (name, old_value, new_value) tuples
+        :param loop: asyncio event loop, callback is then scheduled on it thread safely
+        :return: subscription handle, for unsubscribe
+        """
+        if name not in self._variables:
+            raise ValueError("{} is not a MemoryVariable".format(name))
+
+        target = callback.put_nowait if hasattr(callback, 'put_nowait') else None
+        if target is not None:
+            deliver = lambda name, old, new: target((name, old, new))
+        else:
+            deliver = callback
+
+        if loop is not None:
+            handle = lambda name, old, new: loop.call_soon_threadsafe(deliver, name, old, new)
         else:
-            # ordinary getting
-            return super().__getattribute__(name)
+            handle = deliver
+
+        with self.lock:
+            self._subscriptions.setdefault(name, []).append(handle)
+        return handle
+
+    def unsubscribe(self, name, handle):
+        with self.lock:
+            handles = self._subscriptions.get(name, [])
+            if handle in handles:
+                handles.remove(handle)
+            if not handles:
+                self._subscriptions.pop(name, None)
+
+    def _get_watched(self, address, count, area='holding_registers'):
+        # subscribed variables overlapping written range, with their current values
+        watched = []
+        for name, handles in self._subscriptions.items():
+            variable = self._variables[name]
+            if variable.area == area and variable.address < address + count and address < variable.address + variable.get_word_count():
+                decoder = self._decoders[name]
+                watched.append((name, decoder, decoder(self._store), list(handles)))
+        return watched
+
+    def _notify(self, watched):
+        for name, decoder, old_value, handles in watched:
+            new_value = decoder(self._store)
+            if new_value != old_value:
+                for handle in handles:
+                    handle(name, old_value, new_value)
+
+    def _writing(self):
+        # context of multi register write, see SharedMemoryStore
+        return self.lock
+
+    def update(self, **values):
+        """
+        Set many variables at once, as a single transaction
+        :param values: new values, by variable name
+        """
+        with self.transaction():
+            for name, value in values.items():
+                if name not in self._variables:
+                    raise ValueError("{} is not a MemoryVariable".format(name))
+                setattr(self, name, value)
+
+    def _publish(self, words):
+        # write staged words, one set_range per run of consecutive addresses
+        addresses = sorted(words)
+        with self._writing():
+            start = 0
+            for idx in range(1, len(addresses) + 1):
+                if idx == len(addresses) or addresses[idx] != addresses[idx - 1] + 1:
+                    self.set_range(addresses[start], [words[address] for address in addresses[start:idx]])
+                    start = idx
+            for (area, address), value in sorted(words.areas.items()):
+                if area == 'input_registers':
+                    self.set_input_range(address, (value, ))
+                else:
+                    self.set_bits(area, address, (value, ))
+
+    def get_variables(self):
+        """
+        :return: dict of declared MemoryVariables, by name
+        """
+        return dict(self._variables)
+
+    def set_direction(self, address, count, direction):
+        """
+        Declare data direction of block of holding registers, used by master to skip reads,
+        writes and merge ruled out by it, see DIRECTIONS. Registers are 'both' by default.
+        :param address: starting address, in words
+        :param count: number of words
+        :param direction: 'read', 'write' or 'both'
+        """
+        if direction not in DIRECTIONS:
+            raise ValueError("direction should be one of {}".format(DIRECTIONS))
+        if not (0 <= address and count > 0 and address + count <= self._size):
+            raise ValueError("Size exceeded")
+
+        codes = bytearray(self._size)
+        for start, length, old_direction in self._direction_runs:
+            codes[start:start + length] = bytes([DIRECTIONS.index(old_direction)]) * length
+        codes[address:address + count] = bytes([DIRECTIONS.index(direction)]) * count
+
+        runs = []
+        start = 0
+        for idx in range(1, self._size + 1):
+            if idx == self._size or codes[idx] != codes[start]:
+                runs.append((start, idx - start, DIRECTIONS[codes[start]]))
+                start = idx
+        self._direction_runs = runs
+
+    def set_variable_direction(self, name, direction):
+        """
+        Declare data direction of registers of variable, see set_direction
+        :param name: name of holding register MemoryVariable
+        """
+        variable = self._variables.get(name)
+        if variable is None or variable.area != 'holding_registers' or variable.type == 'bit':
+            raise ValueError("{} is not a holding register MemoryVariable".format(name))
+        self.set_direction(variable.address, variable.get_word_count(), direction)
+
+    def get_direction_runs(self, address=0, count=None):
+        """
+        :param address: starting address of block, in words
+        :param count: number of words in block, None for rest of memory
+        :return: list of (address, count, direction) runs covering the block, sorted by address
+        """
+        count = self._size - address if count is None else count
+        stop = address + count
+        return [(max(start, address), min(start + length, stop) - max(start, address), direction)
+                for start, length, direction in self._direction_runs
+                if start < stop and address < start + length]
+
+    def get_used_ranges(self, area='holding_registers'):
+        """
+        Address space covered by declared variables, eg. for planning sync requests
+        :param area: memory area, see get_area_size
+        :return: list of coalesced (address, count) tuples, sorted by address
+        """
+        if area not in AREAS:
+            raise ValueError("area should be one of {}".format(set(AREAS)))
+        used = bytearray(self._area_sizes[area])
+        for variable in self._variables.values():
+            if variable.area == area:
+                used[variable.address:variable.address + variable.get_word_count()] = b'\x01' * variable.get_word_count()
+        return self._find_ranges(used)
+
+    def compile(self):
+        """
+        Freeze declared variables into a single decoding function, used by snapshot.
+        Called automatically when variables changed since last compilation.
+        :return: (names, decode function, namedtuple class)
+        """
+        if self._layout is None:
+            names = tuple(self._variables)
+            source = "lambda w, i, c, d: ({})".format("".join(
+                self._variables[name].get_expression(AREAS[self._variables[name].area]) + ", " for name in names))
+            snapshot_type = namedtuple('MemorySnapshot', names, rename=True)
+            self._layout = (names, eval(source), snapshot_type)
+        return self._layout
+
+    def snapshot(self, as_namedtuple=False):
+        """
+        Decode all variables in one pass, from a consistent copy of memory
+        :param as_namedtuple: return namedtuple instead of dict
+        :return: dict (or namedtuple) of variable values, by name
+        """
+        names, decode, snapshot_type = self.compile()
+        with self.lock:
+            words = self.get_range(0, self._size)
+            areas = [self._areas[area][:] for area in ('input_registers', 'coils', 'discrete_inputs')]
+        values = decode(words, *areas)
+        if as_namedtuple:
+            return snapshot_type(*values)
+        return dict(zip(names, values))
 
     def dump(self, cols=5):
         leading = int(log10(self._size) + 1)
         fmt = "'{0:0" + str(leading) + "}': {1:05}"
-        pairs = [fmt.format(key, value) for key, value in self._store.items()]
+        pairs = [fmt.format(key, value) for key, value in enumerate(self._store)]
         out = ""
         for idx, pair in enumerate(pairs):
             out += pair + " | "
             if ((idx+1) % cols) == 0:
                 out += "\n"
         out += "\n"
-        return out
\ No newline at end of file
+        return out
+
+
+class _InterProcessLock:
+
+    def __init__(self, path):
+        # reentrant lock of threads and processes: thread lock, then flock of lock file by outermost owner
+        self._lock = RLock()
+        self._depth = 0
+        self._fd = None if fcntl is None else os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0 and self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SharedMemoryStore(MemoryStore):
+    # header: magic, size in words, write sequence (odd while a write is in progress), reserved
+    _header = struct.Struct('<4sIQQ')
+    _header_size = 32
+    _magic = b'MSM2'
+
+    def __init__(self, size=None, name=None, create=True):
+        """
+        MemoryStore placed in a multiprocessing.shared_memory block, so other local processes
+        can attach to it by name. Memory lock is shared by all processes (flock of a lock file in temp
+        directory), so writes, dirty flags and syncs of every process are serialized. Readers do not
+        lock, they get consistent multi register snapshots from a seqlock, also when decoding variables.
+        Without fcntl (eg. on windows) lock only serializes threads, a single writer process is required.
+        MemoryVariables are declared per process.
+        :param size: size of memory, in words, required when creating
+        :param name: name of shared block, random when creating without name
+        :param create: create new block (True) or attach to existing one (False)
+        :return: SharedMemoryStore instance
+        """
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory is not available (python >= 3.8 required)")
+
+        if create:
+            if size is None:
+                raise ValueError("size is required when creating shared memory")
+            shm = shared_memory.SharedMemory(name=name, create=True, size=self._header_size + 3*size)
+            self._header.pack_into(shm.buf, 0, self._magic, size, 0, 0)
+        else:
+            shm = self._attach(name)
+            magic, size, _, _ = self._header.unpack_from(shm.buf, 0)
+            if magic != self._magic:
+                shm.close()
+                raise ValueError("{} is not a SharedMemoryStore block".format(name))
+
+        data_end = self._header_size + 2*size
+        self._shm = shm
+        self._store = shm.buf[self._header_size:data_end].cast('H')
+        self._dirty = shm.buf[data_end:data_end + size]
+        self._size = size
+        self._init_areas(0, 0, 0) # other areas are not shared
+        self._lock_path = os.path.join(tempfile.gettempdir(), '{}.lock'.format(shm.name.lstrip('/')))
+        self.lock = _InterProcessLock(self._lock_path)
+        self._dirty_event = Event()
+        self._last_syncs = {}
+        self._stale_sources = set()
+        self._write_depth = 0
+        self._writer = None # thread ident of write in progress, in this process
+        self._init_variables()
+
+    @staticmethod
+    def _attach(name):
+        # attaching process should not destroy the block at exit, creator owns it
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        shm = shared_memory.SharedMemory(name=name)
+        # older versions register the block on attach too, multiprocessing children share tracker of
+        # their parent, there the registration is the creator's own and should be kept
+        if os.name == 'posix' and parent_process() is None:
+            resource_tracker.unregister('/' + shm.name, 'shared_memory')
+        return shm
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def _sequence(self):
+        return struct.unpack_from('<Q', self._shm.buf, 8)[0]
+
+    @contextmanager
+    def _writing(self):
+        # outermost write makes sequence odd, next even value publishes it
+        with self.lock:
+            if self._write_depth == 0:
+                sequence = self._sequence()
+                # still odd if a writer died in the middle of a write
+                struct.pack_into('<Q', self._shm.buf, 8, sequence + 1 + (sequence & 1))
+                self._writer = get_ident()
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._writer = None
+                    struct.pack_into('<Q', self._shm.buf, 8, self._sequence() + 1)
+
+    def set_value(self, address, value, mark_dirty=True):
+        with self._writing():
+            super().set_value(address, value, mark_dirty)
+
+    def set_range(self, address, values, mark_dirty=True, notify=False):
+        with self._writing():
+            super().set_range(address, values, mark_dirty, notify)
+
+    def get_value(self, address):
+        if not 0 <= address < self._size:
+            raise ValueError("Size exceeded")
+        return self.get_range(address, 1)[0]
+
+    def get_range(self, address, count):
+        if not (0 <= address and count >= 0 and address + count <= self._size):
+            raise ValueError("Size exceeded")
+
+        # retry until copy was made while no write was in progress, inside own write (eg. read back
+        # by subscriptions) there is nothing to wait for
+        own_write = self._writer == get_ident()
+        while True:
+            sequence = self._sequence()
+            if own_write or not sequence & 1:
+                values = array('H')
+                values.frombytes(self._store[address:address + count].cast('B'))
+                if own_write or self._sequence() == sequence:
+                    return values
+            sleep(0)
+
+    def __getattr__(self, name):
+        variable = self.__dict__.get('_variables', {}).get(name)
+        if variable is None or variable.area != 'holding_registers' or get_ident() in self._transactions:
+            return super().__getattr__(name)
+        # words of variable are copied under seqlock, so multi word values are never torn
+        return variable.decode_words(self.get_range(variable.address, variable.get_word_count()))
+
+    def get_dirty_ranges(self, area='holding_registers'):
+        if area != 'holding_registers':
+            return super().get_dirty_ranges(area)
+        return self._find_ranges(bytes(self._dirty))
+
+    def pop_dirty_ranges(self, address=0, count=None, area='holding_registers'):
+        if area != 'holding_registers':
+            return super().pop_dirty_ranges(address, count, area)
+        count = self._size - address if count is None else count
+        if not (0 <= address and count >= 0 and address + count <= self._size):
+            raise ValueError("Size exceeded")
+
+        with self.lock:
+            ranges = self._find_ranges(bytes(self._dirty[address:address + count]))
+            for start, length in ranges:
+                self._dirty[address + start:address + start + length] = bytes(length)
+        return [(address + start, length) for start, length in ranges]
+
+    def __deepcopy__(self, memo):
+        # copy is a private, process local MemoryStore, eg. master's buffered memory
+        copy = MemoryStore(self._size)
+        copy.set_range(0, self.get_range(0, self._size), mark_dirty=False)
+        for name, variable in self._variables.items():
+            setattr(copy, name, deepcopy(variable, memo))
+        return copy
+
+    def close(self):
+        """
+        Detach from shared block, store can not be used afterwards
+        """
+        self._store.release()
+        self._dirty.release()
+        self._shm.close()
+        self.lock.close()
+
+    def unlink(self):
+        """
+        Destroy shared block and its lock file, should be called once, by creating process
+        """
+        self._shm.unlink()
+        try:
+            os.remove(self._lock_path)
+        except FileNotFoundError:
+            pass
+
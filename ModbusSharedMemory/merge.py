@@ -0,0 +1,154 @@
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# outgoing: image to be written to the server, client values where client wins
+# buffer: new content of master's buffered memory
+# memory_ranges: (address, count) runs where memory should take server values
+# client_ranges: (address, count) runs where client wins and server should be written
+# conflicts: number of registers updated on both sides, server wins those
+MergeResult = namedtuple('MergeResult', ['outgoing', 'buffer', 'memory_ranges', 'client_ranges', 'conflicts'])
+
+# block size used by pure python fallback to skip unchanged data
+BLOCK_SIZE = 64
+
+
+def three_way_merge(server_data, memory_data, buffer_data, use_numpy=None):
+    """
+    Resolve server, memory and buffered memory images at once, same rules as ModbusMasterTCP.do_map:
+    server wins if client did not change a register (or on conflict), client wins if server did not.
+    :param server_data: sequence of words read from server
+    :param memory_data: array('H') with current memory content
+    :param buffer_data: array('H') with memory content after last synchronization
+    :param use_numpy: force (True) or disable (False) numpy engine, None picks numpy when installed
+    :return: MergeResult
+    """
+    if not len(server_data) == len(memory_data) == len(buffer_data):
+        raise ValueError("server_data, memory_data and buffer_data should have equal lengths")
+
+    if use_numpy is None:
+        use_numpy = np is not None
+
+    if use_numpy:
+        return _merge_numpy(server_data, memory_data, buffer_data)
+    return _merge_array(server_data, memory_data, buffer_data)
+
+
+def merge_memory(memory, buffered_memory, server_data, dirty_only=False, use_numpy=None, address=0):
+    """
+    Merge server image into memory and buffered_memory, in bulk
+    :param memory: MemoryStore used by application
+    :param buffered_memory: MemoryStore with memory content after last synchronization
+    :param server_data: sequence of words read from server, block starting at address
+    :param dirty_only: merge only registers reported by memory.pop_dirty_ranges, take the rest from server
+    :param use_numpy: passed to three_way_merge
+    :param address: starting address of merged block, ranges of result are relative to it
+    :return: MergeResult
+    """
+    count = len(server_data)
+
+    # local writes wait until merge is applied, otherwise they could be overwritten by server values
+    with memory.lock:
+        memory_data = memory.get_range(address, count)
+        buffer_data = buffered_memory.get_range(address, count)
+
+        if dirty_only:
+            # untouched registers behave as if client did not change them
+            effective_buffer = array('H', memory_data)
+            for start, length in memory.pop_dirty_ranges(address, count):
+                start -= address
+                effective_buffer[start:start + length] = buffer_data[start:start + length]
+            buffer_data = effective_buffer
+
+        result = three_way_merge(server_data, memory_data, buffer_data, use_numpy)
+
+        for start, length in result.memory_ranges:
+            memory.set_range(address + start, result.outgoing[start:start + length], mark_dirty=False, notify=True)
+        buffered_memory.set_range(address, result.buffer)
+
+    return result
+
+
+def _merge_numpy(server_data, memory_data, buffer_data):
+    s = np.asarray(server_data, dtype=np.uint16)
+    m = np.frombuffer(memory_data, dtype=np.uint16)
+    b = np.frombuffer(buffer_data, dtype=np.uint16)
+
+    sm = s != m
+    mb = m != b
+    client = mb & (s == b)
+    conflict = sm & mb & ~client
+
+    outgoing = array('H', np.where(client, m, s).tobytes())
+    buffer = array('H', np.where(sm, np.where(mb, m, s), b).tobytes())
+
+    return MergeResult(outgoing, buffer, _mask_ranges(sm & ~client), _mask_ranges(client), int(np.count_nonzero(conflict)))
+
+
+def _mask_ranges(mask):
+    # runs of True values as (address, count) tuples
+    idx = np.flatnonzero(mask)
+    if not len(idx):
+        return []
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = idx[np.r_[0, breaks]]
+    stops = idx[np.r_[breaks - 1, len(idx) - 1]] + 1
+    return [(int(start), int(stop - start)) for start, stop in zip(starts, stops)]
+
+
+def _merge_array(server_data, memory_data, buffer_data):
+    s = server_data if isinstance(server_data, array) else array('H', server_data)
+    m = memory_data
+    b = buffer_data
+
+    outgoing = array('H', s)
+    buffer = array('H', b)
+    memory_addresses = []
+    client_addresses = []
+    conflicts = 0
+
+    for start in range(0, len(s), BLOCK_SIZE):
+        stop = start + BLOCK_SIZE
+        # whole block unchanged on both sides, compared at C speed
+        if s[start:stop] == m[start:stop] and m[start:stop] == b[start:stop]:
+            continue
+
+        for i in range(start, min(stop, len(s))):
+            server_value = s[i]
+            mem_value = m[i]
+            if server_value == mem_value:
+                continue
+
+            buf_value = b[i]
+            if mem_value == buf_value:
+                # server updated, client did not
+                buffer[i] = server_value
+                memory_addresses.append(i)
+            elif server_value == buf_value:
+                # client updated, server did not
+                buffer[i] = mem_value
+                outgoing[i] = mem_value
+                client_addresses.append(i)
+            else:
+                # conflict, server wins
+                buffer[i] = mem_value
+                memory_addresses.append(i)
+                conflicts += 1
+
+    return MergeResult(outgoing, buffer, _address_ranges(memory_addresses), _address_ranges(client_addresses), conflicts)
+
+
+def _address_ranges(addresses):
+    # coalesce sorted addresses into (address, count) tuples
+    ranges = []
+    for address in addresses:
+        if ranges and ranges[-1][0] + ranges[-1][1] == address:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([address, 1])
+    return [tuple(r) for r in ranges]
@@ -0,0 +1,140 @@
+import json
+from bisect import bisect_left
+from threading import Lock
+
+
+# upper bounds of histogram buckets, latencies in seconds, counts in items
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# metrics reported by masters and slaves, histograms use LATENCY_BUCKETS unless listed here
+#   master_requests_total, master_request_seconds, master_bytes_sent_total, master_bytes_received_total,
+#   master_chunks_per_cycle, master_conflicts_total, master_sync_seconds, master_overruns_total,
+#   master_connection_errors_total,
+#   slave_requests_total{function_code}, slave_exceptions_total{function_code,error_code},
+#   slave_request_seconds, slave_bytes_received_total, slave_bytes_sent_total
+BUCKETS = {
+    'master_chunks_per_cycle': COUNT_BUCKETS,
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        """
+        Distribution of observed values over fixed buckets
+        :param buckets: sorted upper bounds of buckets, values above last one go to +Inf bucket
+        :return: Histogram instance
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+
+class Metrics:
+
+    def __init__(self):
+        """
+        Counters and histograms of masters and slaves, pass instance as metrics argument to enable them.
+        Components created without metrics skip instrumentation altogether.
+        :return: Metrics instance
+        """
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {} # (name, labels) -> value
+            self._histograms = {} # (name, labels) -> Histogram
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        """
+        :param name: name of counter or histogram
+        :param labels: labels of metric, eg. function_code=3
+        :return: value of counter, Histogram, or None when nothing was recorded
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            return self._histograms.get(key)
+
+    def to_dict(self):
+        """
+        :return: dict with 'counters' and 'histograms' lists, entries have name, labels and values
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [dict(name=name, labels=dict(labels), **histogram.to_dict())
+                          for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0])]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='modbus_shared_memory'):
+        """
+        Render metrics in Prometheus text exposition format
+        :param prefix: prepended to metric names
+        :return: str
+        """
+        data = self.to_dict()
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        for counter in data['counters']:
+            name = "{}_{}".format(prefix, counter['name'])
+            declare(name, 'counter')
+            lines.append("{}{} {}".format(name, _labels(counter['labels']), counter['value']))
+
+        for histogram in data['histograms']:
+            name = "{}_{}".format(prefix, histogram['name'])
+            declare(name, 'histogram')
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in histogram['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, histogram['counts']):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _labels(histogram['labels'], le=bound), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(histogram['labels']), histogram['sum']))
+            lines.append("{}_count{} {}".format(name, _labels(histogram['labels']), histogram['count']))
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels.items()) + '}'
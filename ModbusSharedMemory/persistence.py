@@ -0,0 +1,194 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from time import time
+from umodbus import log
+
+# header: magic, version, flags, sizes of holding registers, input registers, coils and discrete inputs,
+# crc32 of payload, time of save, padded to 8 bytes. Payload follows at fixed offsets, in the same order:
+# registers as little endian words, bits packed as in MemoryStore, so an image can be mapped and cast in place.
+_HEADER = struct.Struct('<4sHHIIIIId4x')
+_MAGIC = b'MSMI'
+_VERSION = 1
+HEADER_SIZE = _HEADER.size
+
+_REGISTER_AREAS = ('holding_registers', 'input_registers')
+_BIT_AREAS = ('coils', 'discrete_inputs')
+
+
+def _capture(memory):
+    # consistent copy of all areas, as payload bytes, the only part done under memory lock
+    with memory.lock:
+        holding = memory.get_range(0, memory.get_size())
+        inputs = memory.get_input_range(0, memory.get_area_size('input_registers'))
+        bits = [bytes(memory.get_packed_bits(area, 0, memory.get_area_size(area))) for area in _BIT_AREAS]
+    if sys.byteorder != 'little':
+        holding.byteswap()
+        inputs.byteswap()
+    return b''.join([holding.tobytes(), inputs.tobytes()] + bits)
+
+
+def _sizes(memory):
+    return tuple(memory.get_area_size(area) for area in _REGISTER_AREAS + _BIT_AREAS)
+
+
+def save_memory(memory, path):
+    """
+    Write binary image of all memory areas, atomically: image is written to a temporary file
+    and renamed over path, so a crash never leaves a half written image behind
+    :param memory: MemoryStore to be saved
+    :param path: image file
+    :return: crc32 of saved payload
+    """
+    payload = _capture(memory)
+    crc = zlib.crc32(payload)
+    _write(path, _sizes(memory), payload, crc)
+    return crc
+
+
+def _write(path, sizes, payload, crc):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, 0, *sizes, crc, time()))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def open_image(path):
+    """
+    Map image file into memory, without reading it, payload is checked against its checksum
+    :param path: image file
+    :return: (header, mmap) tuple, header is a dict with 'sizes' (by area), 'offsets' (by area, in bytes)
+             and 'saved_at' (time.time() of save), mmap should be closed by caller
+    """
+    with open(path, 'rb') as f:
+        image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(image) < HEADER_SIZE:
+            raise ValueError("{} is not a memory image".format(path))
+        magic, version, _, holding, inputs, coils, discrete, crc, saved_at = _HEADER.unpack_from(image, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("{} is not a memory image of version {}".format(path, _VERSION))
+
+        sizes = dict(zip(_REGISTER_AREAS + _BIT_AREAS, (holding, inputs, coils, discrete)))
+        lengths = [2*holding, 2*inputs, (coils + 7) // 8, (discrete + 7) // 8]
+        if len(image) != HEADER_SIZE + sum(lengths):
+            raise ValueError("{} is truncated".format(path))
+        with memoryview(image) as view:
+            if zlib.crc32(view[HEADER_SIZE:]) != crc:
+                raise ValueError("{} is corrupted, checksum does not match".format(path))
+    except Exception:
+        image.close()
+        raise
+
+    offsets = {}
+    offset = HEADER_SIZE
+    for area, length in zip(_REGISTER_AREAS + _BIT_AREAS, lengths):
+        offsets[area] = offset
+        offset += length
+    return {'sizes': sizes, 'offsets': offsets, 'saved_at': saved_at}, image
+
+
+def load_memory(memory, path, mark_dirty=False):
+    """
+    Restore all memory areas from image written by save_memory, sizes of areas should match.
+    Memory stays stale (see MemoryStore.is_stale) until synchronized with peer.
+    :param memory: MemoryStore to be restored
+    :param path: image file
+    :param mark_dirty: whether restored registers and coils should be reported by get_dirty_ranges
+    :return: time.time() of save
+    """
+    header, image = open_image(path)
+    try:
+        if tuple(header['sizes'][area] for area in _REGISTER_AREAS + _BIT_AREAS) != _sizes(memory):
+            raise ValueError("sizes of image {} do not match memory {}".format(header['sizes'], _sizes(memory)))
+
+        words = {}
+        with memoryview(image) as view:
+            for area in _REGISTER_AREAS:
+                offset = header['offsets'][area]
+                words[area] = array('H')
+                words[area].frombytes(view[offset:offset + 2*header['sizes'][area]])
+                if sys.byteorder != 'little':
+                    words[area].byteswap()
+            bits = {area: bytes(view[header['offsets'][area]:header['offsets'][area] + (header['sizes'][area] + 7) // 8])
+                    for area in _BIT_AREAS}
+    finally:
+        image.close()
+
+    # whole image is published at once
+    with memory.lock:
+        memory.set_range(0, words['holding_registers'], mark_dirty=mark_dirty, notify=True)
+        memory.set_input_range(0, words['input_registers'], notify=True)
+        for area in _BIT_AREAS:
+            memory.set_packed_bits(area, 0, header['sizes'][area], bits[area], mark_dirty=mark_dirty, notify=True)
+    return header['saved_at']
+
+
+class Checkpointer:
+
+    def __init__(self, memory, path, period=10.0):
+        """
+        Periodic checkpoints of memory to image file, in a background thread. Memory lock is held only
+        while areas are copied, checksum and file writes are done outside of it. Unchanged memory is not
+        written again.
+        :param memory: MemoryStore to be saved
+        :param path: image file, see save_memory
+        :param period: time between checkpoints, in seconds
+        :return: Checkpointer instance
+        """
+        if period <= 0:
+            raise ValueError("period should be positive")
+
+        self.memory = memory
+        self.path = path
+        self.period = period
+        self.checkpoints = 0 # number of images written
+        self._last_crc = None
+        self._killed = threading.Event()
+        self._thread = None
+
+    def checkpoint(self):
+        """
+        Save memory, unless it did not change since last checkpoint
+        :return: True if image was written
+        """
+        payload = _capture(self.memory)
+        crc = zlib.crc32(payload)
+        if crc == self._last_crc:
+            return False
+        _write(self.path, _sizes(self.memory), payload, crc)
+        self._last_crc = crc
+        self.checkpoints += 1
+        return True
+
+    def _start(self):
+        while not self._killed.wait(self.period):
+            try:
+                self.checkpoint()
+            except OSError:
+                # eg. disk full, next checkpoint retries
+                log.exception('Could not write memory image')
+
+    def run(self):
+        self._killed.clear()
+        self._thread = threading.Thread(group=None, target=self._start, daemon=True)
+        self._thread.start()
+
+    def kill(self, final_checkpoint=True):
+        """
+        Stop checkpoints
+        :param final_checkpoint: save memory once more, after thread is stopped
+        """
+        self._killed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if final_checkpoint:
+            self.checkpoint()
@@ -0,0 +1,58 @@
+# largest block read by one request, by memory area
+CHUNK_SIZES = {'holding_registers': 125, 'input_registers': 125, 'coils': 2000, 'discrete_inputs': 2000}
+
+
+def request_count(count, chunk_size):
+    return (count + chunk_size - 1) // chunk_size
+
+
+def block_cost(count, chunk_size, request_cost, unit_cost):
+    """
+    Cost of synchronizing block of consecutive registers (or bits)
+    :param count: size of block
+    :param chunk_size: max size of one request
+    :param request_cost: cost of one round trip, eg. its latency
+    :param unit_cost: cost of one register (or bit) of payload, in units of request_cost
+    :return: cost of block
+    """
+    return request_count(count, chunk_size) * request_cost + count * unit_cost
+
+
+def plan_blocks(ranges, chunk_size=125, request_cost=1.0, unit_cost=0.02):
+    """
+    Merge used ranges into blocks synchronized by single requests (or chunked runs of them).
+    Gap between neighbouring blocks is bridged when reading it is cheaper than an extra round trip,
+    with default costs gaps up to 49 registers are bridged. unit_cost of 0 bridges every gap
+    that does not add a request, a large one never bridges.
+    :param ranges: iterable of (address, count) tuples, may overlap or be unsorted
+    :param chunk_size: max size of one request, see CHUNK_SIZES
+    :param request_cost: cost of one round trip
+    :param unit_cost: cost of one register (or bit) of payload, relative to request_cost
+    :return: list of (address, count) blocks, sorted by address
+    """
+    if request_cost < 0 or unit_cost < 0:
+        raise ValueError("request_cost and unit_cost should not be negative")
+
+    blocks = []
+    for address, count in sorted(ranges):
+        if count <= 0:
+            continue
+        if not blocks:
+            blocks.append([address, count])
+            continue
+
+        start, length = blocks[-1]
+        stop = start + length
+        if address <= stop:
+            # overlapping or adjacent ranges
+            blocks[-1][1] = max(stop, address + count) - start
+            continue
+
+        merged = address + count - start
+        separate = block_cost(length, chunk_size, request_cost, unit_cost) + \
+            block_cost(count, chunk_size, request_cost, unit_cost)
+        if block_cost(merged, chunk_size, request_cost, unit_cost) < separate:
+            blocks[-1][1] = merged
+        else:
+            blocks.append([address, count])
+    return [tuple(block) for block in blocks]
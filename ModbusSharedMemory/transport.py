@@ -0,0 +1,71 @@
+from ModbusSharedMemory.client_server import BaseModbusSlave
+from ModbusSharedMemory.codec import MBAP_HEADER
+
+
+class InProcessTransport:
+
+    def __init__(self, slave):
+        """
+        Transport of ModbusMasterTCP talking to a slave in the same process: requests are executed
+        by slave handlers as soon as they are sent, without sockets, server threads or ports.
+        Slave does not have to listen, a BaseModbusSlave is enough:
+
+            transport = InProcessTransport(BaseModbusSlave(plc_memory))
+            master = ModbusMasterTCP(hmi_memory, transport=transport)
+
+        :param slave: BaseModbusSlave (or ModbusSlaveTCP) serving requests
+        :return: InProcessTransport instance
+        """
+        if not isinstance(slave, BaseModbusSlave):
+            raise ValueError("slave should be instance of BaseModbusSlave")
+        self.slave = slave
+
+    def connect(self):
+        return InProcessSocket(self.slave)
+
+
+class InProcessSocket:
+
+    def __init__(self, slave):
+        """
+        Socket-like end of in-process connection, complete request frames are executed on sendall,
+        their responses are queued for recv, so pipelined requests work too
+        :param slave: BaseModbusSlave serving requests
+        :return: InProcessSocket instance
+        """
+        self.slave = slave
+        self._requests = bytearray()
+        self._responses = bytearray()
+        self._closed = False
+
+    def sendall(self, data):
+        if self._closed:
+            raise OSError("in-process socket is closed")
+        requests = self._requests
+        requests += data
+        while len(requests) >= 7:
+            transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack_from(requests)
+            if len(requests) < 6 + length:
+                break
+            response_pdu = self.slave.execute_pdu(unit_id, bytes(requests[7:6 + length]))
+            self._responses += MBAP_HEADER.pack(transaction_id, protocol_id, len(response_pdu) + 1, unit_id)
+            self._responses += response_pdu
+            del requests[:6 + length]
+
+    def recv(self, size):
+        # nothing queued reads as closed connection, as there is no peer to wait for
+        data = bytes(self._responses[:size])
+        del self._responses[:size]
+        return data
+
+    def recv_into(self, buffer, size=0):
+        size = min(size or len(buffer), len(self._responses))
+        buffer[:size] = self._responses[:size]
+        del self._responses[:size]
+        return size
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self._closed = True
@@ -0,0 +1,219 @@
+"""
+Benchmarks of sync loop, slave request path, variable access and merge.
+
+Runs against an in-process loopback slave (port 0 picks a free one), results are written
+as JSON for regression tracking. From repository root:
+
+    python -m benchmarks.bench_sync --port 5020 --output results.json
+
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from array import array
+from datetime import datetime
+from statistics import median
+
+from ModbusSharedMemory.client_server import ModbusSlaveTCP, ModbusMasterTCP
+from ModbusSharedMemory.transport import InProcessTransport
+from ModbusSharedMemory.memory import MemoryStore, MemoryVariable
+from ModbusSharedMemory import merge
+
+
+SIZES = [8, 64, 512, 4096, 65536]
+CONFLICT_RATES = [0.0, 0.01, 0.1, 0.5]
+
+
+def measure(fn, repeat=5, number=1):
+    """
+    Time fn, best of repeat runs, each calling fn number times
+    :param fn: callable without arguments
+    :param repeat: number of timed runs
+    :param number: calls per run
+    :return: dict with min, median and max time per call, in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - t0) / number)
+    return {'min': min(timings), 'median': median(timings), 'max': max(timings), 'repeat': repeat, 'number': number}
+
+
+class LoopbackSlave:
+
+    def __init__(self, size, port):
+        # slave serving a fresh memory on localhost, for one benchmark
+        self.memory = MemoryStore(size)
+        self.slave = ModbusSlaveTCP(self.memory, port=port, concurrent=True, sync_period=0.01)
+        self.slave.run()
+        self.masters = []
+
+    def master(self, memory, **kwargs):
+        master = ModbusMasterTCP(memory, port=self.slave.app.server_address[1], **kwargs)
+        self.masters.append(master)
+        return master
+
+    def close(self):
+        # masters close first, so the port is not left in TIME_WAIT for the next size
+        for master in self.masters:
+            if master.socket is not None:
+                master.socket.close()
+        self.slave.kill()
+
+
+def bench_sync_cycle(port, sizes, do_map_max, repeat):
+    results = []
+    for size in sizes:
+        loopback = LoopbackSlave(size, port)
+        try:
+            memory = MemoryStore(size)
+            full = loopback.master(memory)
+            dirty = loopback.master(MemoryStore(size), sync_mode='dirty')
+            pipelined = loopback.master(MemoryStore(size), pipeline_depth=8)
+            fast = loopback.master(MemoryStore(size), fast_codec=True)
+            in_process = ModbusMasterTCP(MemoryStore(size), transport=InProcessTransport(loopback.slave), fast_codec=True)
+
+            cases = [('do_map2', full.do_map2),
+                     ('do_map2_pipelined', pipelined.do_map2),
+                     ('do_map2_fast_codec', fast.do_map2),
+                     ('do_map2_in_process', in_process.do_map2),
+                     ('do_map_dirty_idle', dirty.do_map_dirty)]
+
+            def dirty_cycle():
+                dirty.memory.set_value(random.randrange(size), random.randrange(0x10000))
+                dirty.do_map_dirty()
+            cases.append(('do_map_dirty_one_write', dirty_cycle))
+
+            if size <= do_map_max:
+                cases.append(('do_map', full.do_map))
+
+            for name, fn in cases:
+                fn()
+                results.append(dict(name='sync_cycle', case=name, size=size, **measure(fn, repeat)))
+        finally:
+            loopback.close()
+    return results
+
+
+def bench_requests(port, repeat, number, batch=64):
+    results = []
+    loopback = LoopbackSlave(125 * batch, port)
+    try:
+        for depth, fast_codec in ((1, False), (8, False), (1, True)):
+            master = loopback.master(MemoryStore(125 * batch), pipeline_depth=depth, fast_codec=fast_codec)
+            values = list(range(123))
+            cases = [('fc3_125_registers', lambda: master.read_multiple_reg(0, 125)),
+                     ('fc16_123_registers', lambda: master.write_multiple_reg(0, values)),
+                     ('fc3_1_register', lambda: master.read_holding_reg(0)),
+                     ('fc6_1_register', lambda: master.write_holding_reg(0, 1))]
+            for name, fn in cases:
+                result = measure(fn, repeat, number)
+                result['requests_per_second'] = 1 / result['median']
+                results.append(dict(name='request', case=name, pipeline_depth=depth, fast_codec=fast_codec, **result))
+
+            # batch of chunked reads, where pipelining pays off
+            result = measure(lambda: master.read_multiple_reg(0, 125 * batch), repeat)
+            result['requests_per_second'] = batch / result['median']
+            results.append(dict(name='request', case='fc3_batch_{}_requests'.format(batch), pipeline_depth=depth,
+                                fast_codec=fast_codec, **result))
+    finally:
+        loopback.close()
+    return results
+
+
+def bench_variables(repeat, number):
+    results = []
+    memory = MemoryStore(8 + 512)
+    memory.BOOL = MemoryVariable.bool(0, 3)
+    memory.BYTE = MemoryVariable.byte(1, 1)
+    memory.WORD = MemoryVariable.word(2)
+    memory.UINT32 = MemoryVariable.uint32(3)
+    memory.FLOAT32 = MemoryVariable.float32(5)
+    memory.TREND = MemoryVariable.float32(8, count=256)
+    values = {'BOOL': True, 'BYTE': 200, 'WORD': 40000, 'UINT32': 3000000000, 'FLOAT32': 1.5,
+              'TREND': [0.5 * idx for idx in range(256)]}
+
+    for name, value in values.items():
+        get = lambda: getattr(memory, name)
+        put = lambda: setattr(memory, name, value)
+        results.append(dict(name='variable_get', case=name.lower(), **measure(get, repeat, number)))
+        results.append(dict(name='variable_set', case=name.lower(), **measure(put, repeat, number)))
+
+    results.append(dict(name='raw_access', case='get_value', **measure(lambda: memory.get_value(2), repeat, number)))
+    results.append(dict(name='raw_access', case='set_value', **measure(lambda: memory.set_value(2, 7), repeat, number)))
+    results.append(dict(name='raw_access', case='snapshot', **measure(memory.snapshot, repeat, number)))
+    return results
+
+
+def bench_merge(sizes, rates, repeat):
+    engines = [('array', False)] + ([('numpy', True)] if merge.np is not None else [])
+    rnd = random.Random(0)
+    results = []
+    for size in sizes:
+        buffer = [rnd.randrange(0x10000) for _ in range(size)]
+        for rate in rates:
+            # rate of registers changed by server, by client, and by both (conflicts)
+            server = list(buffer)
+            memory = list(buffer)
+            for address in rnd.sample(range(size), int(size * rate)):
+                side = rnd.randrange(3)
+                if side != 1:
+                    server[address] = (server[address] + 1) & 0xFFFF
+                if side != 0:
+                    memory[address] = (memory[address] + 2) & 0xFFFF
+
+            memory_data = array('H', memory)
+            buffer_data = array('H', buffer)
+            for engine, use_numpy in engines:
+                fn = lambda: merge.three_way_merge(server, memory_data, buffer_data, use_numpy)
+                results.append(dict(name='merge', case=engine, size=size, rate=rate, **measure(fn, repeat)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=5020, help="port of loopback slave")
+    parser.add_argument('--output', default=None, help="JSON results file, stdout when not given")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="memory sizes, in registers")
+    parser.add_argument('--do-map-max', type=int, default=512, help="largest size benchmarked with legacy do_map")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=1000, help="calls per run of short benchmarks")
+    parser.add_argument('--only', nargs='+', choices=['sync', 'requests', 'variables', 'merge'],
+                        default=['sync', 'requests', 'variables', 'merge'])
+    args = parser.parse_args(argv)
+
+    results = []
+    if 'sync' in args.only:
+        results += bench_sync_cycle(args.port, args.sizes, args.do_map_max, args.repeat)
+    if 'requests' in args.only:
+        results += bench_requests(args.port, args.repeat, args.number)
+    if 'variables' in args.only:
+        results += bench_variables(args.repeat, args.number)
+    if 'merge' in args.only:
+        results += bench_merge(args.sizes, CONFLICT_RATES, args.repeat)
+
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'numpy': merge.np is not None,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
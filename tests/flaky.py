@@ -0,0 +1,25 @@
+from umodbus.exceptions import ServerDeviceFailureError
+from umodbus.utils import pack_exception_pdu
+from ModbusSharedMemory.client_server import BaseModbusSlave
+from ModbusSharedMemory.async_client_server import AsyncModbusSlaveTCP
+
+# functions writing coils or registers
+WRITE_FUNCTIONS = {5, 6, 15, 16, 23}
+
+
+class FailingWrites:
+    # slave answering writes with server device failure while fail_writes is set
+    fail_writes = False
+
+    def execute_pdu(self, slave_id, request_pdu):
+        if self.fail_writes and request_pdu[0] in WRITE_FUNCTIONS:
+            return pack_exception_pdu(request_pdu[0], ServerDeviceFailureError.error_code)
+        return super().execute_pdu(slave_id, request_pdu)
+
+
+class FlakySlave(FailingWrites, BaseModbusSlave):
+    pass
+
+
+class AsyncFlakySlave(FailingWrites, AsyncModbusSlaveTCP):
+    pass
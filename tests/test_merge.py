@@ -0,0 +1,89 @@
+import random
+from array import array
+import pytest
+from ModbusSharedMemory import merge
+from ModbusSharedMemory.merge import three_way_merge, merge_memory, BLOCK_SIZE
+from ModbusSharedMemory.memory import MemoryStore
+
+ENGINES = [False, pytest.param(True, marks=pytest.mark.skipif(merge.np is None, reason="numpy is not installed"))]
+
+
+def reference_merge(server_data, memory_data, buffer_data):
+    # per register rules of ModbusMasterTCP.do_map
+    memory = list(memory_data)
+    buffer = list(buffer_data)
+    outgoing = list(server_data)
+    memory_changed = [False] * len(server_data)
+    client_changed = [False] * len(server_data)
+    conflicts = 0
+    for i, (server_value, mem_value, buf_value) in enumerate(zip(server_data, memory_data, buffer_data)):
+        if server_value != mem_value and mem_value != buf_value and server_value != buf_value:
+            # conflict, server wins
+            buffer[i] = mem_value
+            memory[i] = server_value
+            memory_changed[i] = True
+            conflicts += 1
+        elif server_value != mem_value and mem_value == buf_value:
+            buffer[i] = server_value
+            memory[i] = server_value
+            memory_changed[i] = True
+        elif server_value == buf_value and mem_value != buf_value:
+            buffer[i] = mem_value
+            outgoing[i] = mem_value
+            client_changed[i] = True
+    return memory, buffer, outgoing, runs(memory_changed), runs(client_changed), conflicts
+
+
+def runs(flags):
+    found = []
+    for i, flag in enumerate(flags):
+        if flag and found and found[-1][0] + found[-1][1] == i:
+            found[-1] = (found[-1][0], found[-1][1] + 1)
+        elif flag:
+            found.append((i, 1))
+    return found
+
+
+def images(seed, size, change_rate):
+    # buffer, then memory and server each changed at random, from a small range of values to get conflicts
+    rnd = random.Random(seed)
+    buffer_data = array('H', (rnd.randrange(4) for _ in range(size)))
+    memory_data = array('H', (rnd.randrange(4) if rnd.random() < change_rate else value for value in buffer_data))
+    server_data = array('H', (rnd.randrange(4) if rnd.random() < change_rate else value for value in buffer_data))
+    return server_data, memory_data, buffer_data
+
+
+@pytest.mark.parametrize('use_numpy', ENGINES)
+@pytest.mark.parametrize('size', [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, 3*BLOCK_SIZE + 5, 1000])
+@pytest.mark.parametrize('change_rate', [0.0, 0.01, 0.3, 1.0])
+def test_three_way_merge_matches_reference(use_numpy, size, change_rate):
+    for seed in range(5):
+        server_data, memory_data, buffer_data = images(seed, size, change_rate)
+        memory, buffer, outgoing, memory_ranges, client_ranges, conflicts = \
+            reference_merge(server_data, memory_data, buffer_data)
+
+        result = three_way_merge(server_data, memory_data, buffer_data, use_numpy)
+        assert list(result.outgoing) == outgoing
+        assert list(result.buffer) == buffer
+        assert result.memory_ranges == memory_ranges
+        assert result.client_ranges == client_ranges
+        assert result.conflicts == conflicts
+        # memory takes outgoing values on memory ranges
+        merged = list(memory_data)
+        for start, length in result.memory_ranges:
+            merged[start:start + length] = result.outgoing[start:start + length]
+        assert merged == memory
+
+
+@pytest.mark.parametrize('use_numpy', ENGINES)
+def test_merge_memory_applies_reference(use_numpy):
+    server_data, memory_data, buffer_data = images(7, 300, 0.2)
+    memory = MemoryStore(300)
+    memory.set_range(0, memory_data, mark_dirty=False)
+    buffered_memory = MemoryStore(300)
+    buffered_memory.set_range(0, buffer_data, mark_dirty=False)
+    expected_memory, expected_buffer, _, _, _, _ = reference_merge(server_data, memory_data, buffer_data)
+
+    merge_memory(memory, buffered_memory, server_data, use_numpy=use_numpy)
+    assert list(memory.get_range(0, 300)) == expected_memory
+    assert list(buffered_memory.get_range(0, 300)) == expected_buffer
@@ -0,0 +1,43 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+# creator unlinks block after a multiprocessing child attached to it and exited
+SCRIPT = textwrap.dedent("""
+    import multiprocessing
+    from ModbusSharedMemory.memory import SharedMemoryStore
+
+    def attach(name):
+        memory = SharedMemoryStore(name=name, create=False)
+        memory.set_value(1, 11)
+        memory.close()
+
+    if __name__ == '__main__':
+        multiprocessing.set_start_method('{}')
+        memory = SharedMemoryStore(10)
+        child = multiprocessing.Process(target=attach, args=(memory.name,))
+        child.start()
+        child.join()
+        assert child.exitcode == 0
+        assert memory.get_value(1) == 11
+        memory.close()
+        memory.unlink()
+""")
+
+
+def run_script(start_method, tmp_path):
+    path = tmp_path / 'attach.py'
+    path.write_text(SCRIPT.format(start_method))
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).parents[1]))
+    return subprocess.run([sys.executable, str(path)], capture_output=True, text=True, timeout=60, env=env)
+
+
+def test_child_attach_keeps_creator_registration(tmp_path):
+    for start_method in set(multiprocessing.get_all_start_methods()) & {'fork', 'spawn'}:
+        result = run_script(start_method, tmp_path)
+        assert result.returncode == 0, result.stderr
+        assert 'KeyError' not in result.stderr
+        assert 'leaked' not in result.stderr
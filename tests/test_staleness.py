@@ -0,0 +1,56 @@
+import time
+from ModbusSharedMemory.client_server import BaseModbusSlave, ModbusMasterTCP
+from ModbusSharedMemory.memory import MemoryStore
+from ModbusSharedMemory.transport import InProcessTransport
+
+
+class DeadTransport:
+    # slave that is down, every connect is refused
+    def connect(self):
+        raise ConnectionRefusedError("slave is down")
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_dead_source_keeps_shared_memory_stale():
+    # two sources mapped into regions of one memory, as gateway.ModbusGateway does
+    plc = MemoryStore(10)
+    plc.set_value(1, 11)
+    memory = MemoryStore(20)
+    alive = ModbusMasterTCP(memory, sync_period=0.01, transport=InProcessTransport(BaseModbusSlave(plc)))
+    alive.add_region(0, 10)
+    dead = ModbusMasterTCP(memory, sync_period=0.01, transport=DeadTransport(), reconnect_delay=0.01,
+                           max_reconnect_delay=0.01)
+    dead.add_region(10, 10)
+    alive.run()
+    dead.run()
+    try:
+        assert wait_for(lambda: memory.get_value(1) == 11 and alive.stats['cycles'] > 5)
+        assert wait_for(lambda: dead.stats['connection_errors'] > 5)
+        assert memory.is_stale()
+        assert memory.get_last_sync() is None
+
+        dead.transport = InProcessTransport(BaseModbusSlave(MemoryStore(20)))
+        assert wait_for(lambda: not memory.is_stale())
+        assert not memory.is_stale(max_age=1.0)
+    finally:
+        alive.kill()
+        dead.kill()
+
+
+def test_staleness_per_source():
+    memory = MemoryStore(10)
+    assert memory.is_stale()
+    memory.set_synced('a')
+    memory.set_stale('b')
+    assert memory.is_stale()
+    memory.set_synced('b')
+    assert not memory.is_stale()
+    memory.set_stale('a')
+    memory.set_synced('b')
+    assert memory.is_stale()
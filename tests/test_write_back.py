@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from umodbus.exceptions import ServerDeviceFailureError
+from ModbusSharedMemory.client_server import ModbusMasterTCP
+from ModbusSharedMemory.async_client_server import AsyncModbusMasterTCP
+from ModbusSharedMemory.memory import MemoryStore
+from ModbusSharedMemory.transport import InProcessTransport
+from flaky import FlakySlave, AsyncFlakySlave
+
+
+def sync_once(master):
+    return {'full': master.do_map2, 'dirty': master.do_map_dirty, 'fc23': master.do_map_fc23}[master.sync_mode]()
+
+
+def failed_cycle(slave, sync):
+    # local writes survive a cycle whose write back fails
+    slave.fail_writes = True
+    with pytest.raises(ServerDeviceFailureError):
+        sync()
+    slave.fail_writes = False
+
+
+@pytest.mark.parametrize('sync_mode', ['full', 'dirty', 'fc23'])
+@pytest.mark.parametrize('direction', ['both', 'write'])
+def test_failed_write_back_is_resent(sync_mode, direction):
+    plc = MemoryStore(20)
+    slave = FlakySlave(plc)
+    hmi = MemoryStore(20)
+    hmi.set_direction(0, 5, direction)
+    master = ModbusMasterTCP(hmi, transport=InProcessTransport(slave), sync_mode=sync_mode)
+    sync_once(master)
+
+    hmi.set_value(1, 99)
+    failed_cycle(slave, lambda: sync_once(master))
+    assert hmi.get_value(1) == 99
+
+    sync_once(master)
+    sync_once(master)
+    assert plc.get_value(1) == 99
+    assert hmi.get_value(1) == 99
+
+
+@pytest.mark.parametrize('sync_mode', ['full', 'dirty'])
+@pytest.mark.parametrize('direction', ['both', 'write'])
+def test_async_failed_write_back_is_resent(sync_mode, direction):
+    async def scenario():
+        plc = MemoryStore(20)
+        slave = AsyncFlakySlave(plc, port=0)
+        await slave.run()
+        hmi = MemoryStore(20)
+        hmi.set_direction(0, 5, direction)
+        master = AsyncModbusMasterTCP(hmi, sync_mode=sync_mode, port=slave.server.sockets[0].getsockname()[1])
+        await master.connect()
+        sync = master.do_map2 if sync_mode == 'full' else master.do_map_dirty
+        try:
+            await sync()
+            hmi.set_value(1, 99)
+            slave.fail_writes = True
+            with pytest.raises(ServerDeviceFailureError):
+                await sync()
+            slave.fail_writes = False
+            assert hmi.get_value(1) == 99
+
+            await sync()
+            await sync()
+            assert plc.get_value(1) == 99
+            assert hmi.get_value(1) == 99
+        finally:
+            master.writer.close()
+            slave.kill()
+
+    asyncio.run(scenario())
+
+
+def test_failed_coil_write_is_resent():
+    plc = MemoryStore(0, coils=16)
+    slave = FlakySlave(plc)
+    hmi = MemoryStore(0, coils=16)
+    master = ModbusMasterTCP(hmi, transport=InProcessTransport(slave))
+    master.do_map_area('coils')
+
+    hmi.set_bits('coils', 2, [True])
+    failed_cycle(slave, lambda: master.do_map_area('coils'))
+    assert hmi.get_bits('coils', 2, 1) == [True]
+
+    master.do_map_area('coils')
+    master.do_map_area('coils')
+    assert plc.get_bits('coils', 2, 1) == [True]
+    assert hmi.get_bits('coils', 2, 1) == [True]